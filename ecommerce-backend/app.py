@@ -1,11 +1,17 @@
-from flask import Flask, jsonify, request, session, current_app
+from flask import Flask, jsonify, request, session, current_app, g, send_file, make_response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from sqlalchemy import or_
+from sqlalchemy import or_, func, insert, select, update, literal, text
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from requests.adapters import HTTPAdapter
 from marshmallow import ValidationError, fields
 import requests
 import os
@@ -14,10 +20,33 @@ from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 import stripe
 from functools import wraps
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import OrderedDict
 from flask import abort
 import json
+import hashlib
+import math
+import zlib
+import random
+import socket
+import threading
+import time
 import traceback
 import logging
+import click
+try:
+   import fcntl
+except ImportError:
+   # Windows; the development server runs a single process anyway
+   fcntl = None
+from search_index import PrefixIndex
+from recommendations import top_k_cooccurrence
+from facets import FacetIndex
+from columnar_catalog import ColumnarCatalog, ensure_snapshot, prune_snapshots
+from catalog_import import PRODUCT_FIELDS, iter_rows, validate_row
+from singleflight import SingleFlight, SingleFlightTimeout
+from profiler import RequestProfile, ProfileStore, sign_profile_token, verify_profile_token
 
 
 # Load environment variables
@@ -37,8 +66,39 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///eco
 if app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres://"):
    app.config['SQLALCHEMY_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace("postgres://", "postgresql://", 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+   # One connection per request thread (or green thread, see gunicorn.conf.py)
+   app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+      'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+      'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+      'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+      'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+      'pool_pre_ping': True
+   }
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'jwt-secret-string-the-second')  
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+app.config['RELATED_PRODUCTS_TOP_K'] = int(os.getenv('RELATED_PRODUCTS_TOP_K', 10))
+app.config['TRENDING_HALF_LIFE_HOURS'] = float(os.getenv('TRENDING_HALF_LIFE_HOURS', 72))
+app.config['CATALOG_CACHE_TTL'] = int(os.getenv('CATALOG_CACHE_TTL', 60))
+app.config['CATALOG_VERSION_CHECK_SECONDS'] = float(os.getenv('CATALOG_VERSION_CHECK_SECONDS', 1))
+# How long a suggest request waits for the typeahead index to finish building
+app.config['SUGGEST_BUILD_WAIT_SECONDS'] = float(os.getenv('SUGGEST_BUILD_WAIT_SECONDS', 0.5))
+app.config['BULK_IMPORT_CHUNK_SIZE'] = int(os.getenv('BULK_IMPORT_CHUNK_SIZE', 500))
+app.config['COLUMNAR_CATALOG'] = os.getenv('COLUMNAR_CATALOG', '').lower() in ('1', 'true')
+app.config['COLUMNAR_CATALOG_DIR'] = os.getenv('COLUMNAR_CATALOG_DIR', os.path.join(app.instance_path, 'columnar'))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_BASE_SECONDS'] = float(os.getenv('JOB_RETRY_BASE_SECONDS', 10))
+app.config['JOB_LEASE_SECONDS'] = int(os.getenv('JOB_LEASE_SECONDS', 600))
+app.config['PROFILER_SECRET'] = os.getenv('PROFILER_SECRET')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_MODE'] = os.getenv('PROFILE_MODE', 'sampler')  # sampler or cprofile
+app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL_MS', 1)) / 1000
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_KEEP'] = int(os.getenv('PROFILE_KEEP', 200))
+app.config['CART_IDLE_DAYS'] = int(os.getenv('CART_IDLE_DAYS', 30))
+app.config['ORDER_ARCHIVE_AFTER_DAYS'] = int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', 365))
+app.config['SINGLE_FLIGHT_TIMEOUT'] = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 15))
+app.config['STOCK_RESERVATION_TTL'] = timedelta(minutes=int(os.getenv('STOCK_RESERVATION_TTL_MINUTES', 15)))
 
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
@@ -52,13 +112,107 @@ stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
 if not stripe.api_key:
    raise ValueError("No Stripe API key set. Please set the STRIPE_SECRET_KEY environment variable.")
 
-FAKESTORE_API_URL = "https://fakestoreapi.com"
+# Point at stripe-mock (or a test stand-in) with STRIPE_API_BASE=http://localhost:12111
+if os.getenv('STRIPE_API_BASE'):
+   stripe.api_base = os.getenv('STRIPE_API_BASE')
+
+# One pooled session shared by all threads, with explicit connect/read timeouts
+stripe_session = requests.Session()
+stripe_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('STRIPE_POOL_SIZE', 10))))
+stripe_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('STRIPE_POOL_SIZE', 10))))
+stripe.default_http_client = stripe.http_client.RequestsClient(
+   timeout=(float(os.getenv('STRIPE_CONNECT_TIMEOUT', 3)), float(os.getenv('STRIPE_READ_TIMEOUT', 20))),
+   session=stripe_session
+)
+stripe.max_network_retries = int(os.getenv('STRIPE_MAX_NETWORK_RETRIES', 2))
+
+FAKESTORE_API_URL = os.getenv('FAKESTORE_API_URL', "https://fakestoreapi.com")
+FAKESTORE_TIMEOUT = (float(os.getenv('FAKESTORE_CONNECT_TIMEOUT', 3)), float(os.getenv('FAKESTORE_READ_TIMEOUT', 10)))
+
+# Shared keep-alive pool for the FakeStore proxy routes
+fakestore_session = requests.Session()
+fakestore_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('FAKESTORE_POOL_SIZE', 20))))
+fakestore_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('FAKESTORE_POOL_SIZE', 20))))
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+#### Request profiling ####
+# Off unless a request carries a valid signed X-Profile header or is picked
+# by PROFILE_SAMPLE_RATE; the hooks below then cost one context var lookup.
+active_profile = ContextVar('active_profile', default=None)
+profile_store = ProfileStore(app.config['PROFILE_DIR'], keep=app.config['PROFILE_KEEP'])
+
+class ProfilingJSONProvider(DefaultJSONProvider):
+   def dumps(self, obj, **kwargs):
+      profile = active_profile.get()
+      if profile is None:
+         return super().dumps(obj, **kwargs)
+      started = time.perf_counter()
+      try:
+         return super().dumps(obj, **kwargs)
+      finally:
+         profile.serialize_seconds += time.perf_counter() - started
+
+app.json = ProfilingJSONProvider(app)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def profile_query_start(conn, cursor, statement, parameters, context, executemany):
+   if active_profile.get() is not None:
+      conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def profile_query_end(conn, cursor, statement, parameters, context, executemany):
+   profile = active_profile.get()
+   if profile is not None and conn.info.get('profile_query_start'):
+      profile.sql_seconds += time.perf_counter() - conn.info['profile_query_start'].pop()
+      profile.sql_count += 1
+
+@app.before_request
+def start_request_profile():
+   token = request.headers.get('X-Profile')
+   if token:
+      if not verify_profile_token(app.config['PROFILER_SECRET'], token):
+         return
+      trigger = 'header'
+   elif app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+      trigger = 'sampled'
+   else:
+      return
+   g.profile = RequestProfile(app.config['PROFILE_MODE'], app.config['PROFILE_INTERVAL'])
+   g.profile_trigger = trigger
+   g.profile_context = active_profile.set(g.profile)
+
+@app.after_request
+def finish_request_profile(response):
+   profile = g.pop('profile', None)
+   if profile is None:
+      return response
+   profile.finish()
+   active_profile.reset(g.pop('profile_context'))
+   try:
+      meta = profile_store.save(profile, {
+         'route': request.url_rule.rule if request.url_rule else None,
+         'endpoint': request.endpoint,
+         'method': request.method,
+         'path': request.path,
+         'status': response.status_code,
+         'trigger': g.profile_trigger
+      })
+      response.headers['X-Profile-Id'] = meta['id']
+   except OSError as e:
+      logger.error(f"Could not save request profile: {str(e)}")
+   return response
+
+@app.teardown_request
+def discard_request_profile(exc):
+   profile = g.pop('profile', None)
+   if profile is not None:
+      profile.finish()
+      active_profile.reset(g.pop('profile_context'))
+
 #### Helper function to check if a user is an admin ####
 def admin_required(fn):
    @wraps(fn)
@@ -70,6 +224,33 @@ def admin_required(fn):
       return fn(*args, **kwargs)
    return wrapper
 
+#### Request coalescing ####
+# Concurrent identical GETs to a coalesced view share one execution within
+# the worker; the first request runs the view and the rest reuse its response.
+request_flight = SingleFlight(app.config['SINGLE_FLIGHT_TIMEOUT'])
+
+def coalesce_requests(view):
+   @wraps(view)
+   def wrapper(*args, **kwargs):
+      if request.method != 'GET':
+         return view(*args, **kwargs)
+      key = (
+         request.url_rule.rule,
+         tuple(sorted(request.view_args.items())),
+         tuple(sorted((k, v) for k, v in request.args.items(multi=True) if v != ''))
+      )
+
+      def run():
+         response = make_response(view(*args, **kwargs))
+         return response.get_data(), response.status_code, list(response.headers.items())
+
+      try:
+         body, status, headers = request_flight.do(key, run)
+      except SingleFlightTimeout:
+         return jsonify({"message": "Timed out waiting for an identical request"}), 504
+      return app.response_class(body, status=status, headers=headers)
+   return wrapper
+
 #### Create admin user ####
 def create_admin_user(username, email, password):
    # Check if user already exists
@@ -108,12 +289,42 @@ class Product(db.Model):
    image = db.Column(db.String(200))
    rating = db.Column(db.Float)
    rating_count = db.Column(db.Integer)
+   sku = db.Column(db.String(64))
+   __table_args__ = (
+      db.Index('ix_product_sku', 'sku', unique=True),
+      db.Index('ix_product_category_price', 'category', 'price'),
+      db.Index('ix_product_price', 'price'),
+      db.Index('ix_product_rating', 'rating', 'rating_count'),
+   )
+
+class CatalogVersion(db.Model):
+   # Single row; bumped in the same transaction as every admin catalog write
+   id = db.Column(db.Integer, primary_key=True)
+   version = db.Column(db.Integer, nullable=False, default=0)
+   updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+   # Change feed clients at or below this version must resync from scratch
+   compacted_through = db.Column(db.Integer)
+
+class CatalogChange(db.Model):
+   # Latest change per product, so the table never outgrows the catalog
+   # plus its unexpired tombstones
+   product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+   version = db.Column(db.Integer, nullable=False)
+   deleted = db.Column(db.Boolean, nullable=False, default=False)
+   changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+   __table_args__ = (
+      db.Index('ix_catalog_change_version', 'version', 'product_id'),
+   )
 
 class Cart(db.Model):
    id = db.Column(db.Integer, primary_key=True)
    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+   updated_at = db.Column(db.DateTime, default=datetime.utcnow)
    items = db.relationship('CartItem', backref='cart', lazy=True)
+   __table_args__ = (
+      db.Index('ix_cart_updated_at', 'updated_at'),
+   )
 
 class CartItem(db.Model):
    id = db.Column(db.Integer, primary_key=True)
@@ -129,6 +340,9 @@ class Order(db.Model):
    shipping_address = db.Column(db.String(255), nullable=False)
    created_at = db.Column(db.DateTime, default=datetime.utcnow)
    status = db.Column(db.String(20), default='pending')
+   # False until the record_order_sales job adds the order to the sales
+   # counters; NULL for orders placed before that job existed, which were counted
+   sales_recorded = db.Column(db.Boolean)
 
 class OrderItem(db.Model):
    id = db.Column(db.Integer, primary_key=True)
@@ -138,6 +352,90 @@ class OrderItem(db.Model):
    price = db.Column(db.Float, nullable=False)
    title = db.Column(db.String(200), nullable=True)
 
+class ArchivedOrder(db.Model):
+   # Cold orders, each stored with its items as one zlib-compressed JSON
+   # payload. On Postgres the table is range-partitioned by month.
+   __tablename__ = 'order_archive'
+   id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+   created_at = db.Column(db.DateTime, primary_key=True)
+   user_id = db.Column(db.Integer, nullable=False)
+   archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+   payload = db.Column(db.LargeBinary, nullable=False)
+   __table_args__ = (
+      db.Index('ix_order_archive_user_created', 'user_id', 'created_at'),
+      db.Index('ix_order_archive_id', 'id'),
+      {'postgresql_partition_by': 'RANGE (created_at)'},
+   )
+
+class Job(db.Model):
+   id = db.Column(db.Integer, primary_key=True)
+   name = db.Column(db.String(100), nullable=False)
+   payload = db.Column(db.Text, nullable=False, default='{}')
+   status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, dead
+   attempts = db.Column(db.Integer, nullable=False, default=0)
+   max_attempts = db.Column(db.Integer, nullable=False)
+   run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+   created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+   started_at = db.Column(db.DateTime)
+   finished_at = db.Column(db.DateTime)
+   locked_by = db.Column(db.String(100))
+   last_error = db.Column(db.Text)
+   __table_args__ = (
+      db.Index('ix_job_status_run_at', 'status', 'run_at'),
+      db.Index('ix_job_name_run_at', 'name', 'run_at'),
+   )
+
+class ProductStats(db.Model):
+   product_id = db.Column(db.Integer, primary_key=True)
+   units_sold = db.Column(db.Integer, nullable=False, default=0)
+   # log2 of the sum of units sold, each weighted 2^(hours since TRENDING_EPOCH / half-life)
+   trending_score = db.Column(db.Float, nullable=False)
+   __table_args__ = (
+      db.Index('ix_product_stats_units_sold', 'units_sold', 'product_id'),
+      db.Index('ix_product_stats_trending_score', 'trending_score', 'product_id'),
+   )
+
+class PaymentIntentRecord(db.Model):
+   # The Stripe PaymentIntent already opened for a user's cart contents
+   id = db.Column(db.Integer, primary_key=True)
+   user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+   cart_hash = db.Column(db.String(64), nullable=False)
+   intent_id = db.Column(db.String(255), nullable=False)
+   client_secret = db.Column(db.String(255), nullable=False)
+   amount = db.Column(db.Integer, nullable=False)
+   currency = db.Column(db.String(3), nullable=False, default='usd')
+   # Bumped on every amount change so each change gets its own idempotency key
+   revision = db.Column(db.Integer, default=0)
+   created_at = db.Column(db.DateTime, default=datetime.utcnow)
+   __table_args__ = (
+      db.UniqueConstraint('user_id', 'cart_hash', name='uq_payment_intent_record_user_cart'),
+   )
+
+class ProductInventory(db.Model):
+   # Kept out of product so checkout writes only touch this narrow row.
+   # Products without a row are not stock tracked.
+   product_id = db.Column(db.Integer, primary_key=True)
+   stock = db.Column(db.Integer, nullable=False, default=0)
+
+class StockReservation(db.Model):
+   id = db.Column(db.Integer, primary_key=True)
+   user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+   product_id = db.Column(db.Integer, nullable=False)
+   quantity = db.Column(db.Integer, nullable=False)
+   status = db.Column(db.String(20), nullable=False, default='held')  # held, committed, released
+   order_id = db.Column(db.Integer, index=True)
+   created_at = db.Column(db.DateTime, default=datetime.utcnow)
+   expires_at = db.Column(db.DateTime)
+   __table_args__ = (
+      db.Index('ix_stock_reservation_status_expires_at', 'status', 'expires_at'),
+   )
+
+class RelatedProduct(db.Model):
+   # Top-K "frequently bought together" neighbours per product
+   product_id = db.Column(db.Integer, primary_key=True)
+   related_id = db.Column(db.Integer, primary_key=True)
+   score = db.Column(db.Integer, nullable=False)
+
 
 ####  Schemas  ####
 class UserSchema(ma.Schema):
@@ -146,7 +444,7 @@ class UserSchema(ma.Schema):
 
 class ProductSchema(ma.Schema):
    class Meta:
-      fields = ("id", "title", "price", "description", "category", "image")
+      fields = ("id", "sku", "title", "price", "description", "category", "image")
 
 class CartItemSchema(ma.Schema):
    class Meta:
@@ -163,8 +461,201 @@ cart_schema = CartSchema()
 product_schema = ProductSchema()
 products_schema = ProductSchema(many=True)
 
+#### Order archive ####
+# Only finished orders are moved to cold storage
+ARCHIVABLE_STATUSES = ('delivered', 'cancelled')
+
+def order_to_dict(order, items):
+   return {
+      'id': order.id,
+      'total_amount': order.total_amount,
+      'status': order.status,
+      'shipping_address': order.shipping_address,
+      'created_at': order.created_at.isoformat(),
+      'items': [{
+         'product_id': item.product_id,
+         'quantity': item.quantity,
+         'price': item.price,
+         'title': item.title
+      } for item in items]
+   }
+
+def archived_order_to_dict(row):
+   return dict(json.loads(zlib.decompress(row.payload)), archived=True)
+
+def archived_order_lines():
+   """(order_id, product_id, quantity, created_at) for every archived, non-cancelled order line."""
+   for row in ArchivedOrder.query.yield_per(1000):
+      order = archived_order_to_dict(row)
+      if order['status'] == 'cancelled':
+         continue
+      for item in order['items']:
+         yield row.id, item['product_id'], item['quantity'], row.created_at
+
+def ensure_archive_partitions(created_ats):
+   if db.engine.dialect.name != 'postgresql':
+      return
+   for year, month in sorted({(at.year, at.month) for at in created_ats}):
+      start = datetime(year, month, 1)
+      end = datetime(year + month // 12, month % 12 + 1, 1)
+      db.session.execute(text(
+         f"CREATE TABLE IF NOT EXISTS order_archive_{year}_{month:02d} PARTITION OF order_archive "
+         f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+      ))
+
+def archive_orders(older_than, chunk_size=500):
+   """Move finished orders created before ``older_than`` into order_archive, one chunk per transaction."""
+   # The newest order always stays, so SQLite never hands out an archived id again
+   newest = db.session.query(func.max(Order.id)).scalar()
+   archived = 0
+   while True:
+      orders = Order.query.filter(
+         Order.created_at < older_than,
+         Order.status.in_(ARCHIVABLE_STATUSES),
+         Order.id != newest
+      ).order_by(Order.id).limit(chunk_size).all()
+      if not orders:
+         return archived
+      ids = [order.id for order in orders]
+      items = {}
+      for item in OrderItem.query.filter(OrderItem.order_id.in_(ids)).order_by(OrderItem.id):
+         items.setdefault(item.order_id, []).append(item)
+
+      ensure_archive_partitions(order.created_at for order in orders)
+      db.session.execute(insert(ArchivedOrder), [{
+         'id': order.id,
+         'created_at': order.created_at,
+         'user_id': order.user_id,
+         'archived_at': datetime.utcnow(),
+         'payload': zlib.compress(json.dumps(
+            dict(order_to_dict(order, items.get(order.id, [])), user_id=order.user_id),
+            separators=(',', ':')
+         ).encode())
+      } for order in orders])
+      OrderItem.query.filter(OrderItem.order_id.in_(ids)).delete(synchronize_session=False)
+      StockReservation.query.filter(StockReservation.order_id.in_(ids)).delete(synchronize_session=False)
+      Order.query.filter(Order.id.in_(ids)).delete(synchronize_session=False)
+      db.session.commit()
+      archived += len(ids)
+
+def purge_idle_carts(idle_since, chunk_size=500, max_chunks=None):
+   """Delete carts untouched since ``idle_since`` in chunks; returns (carts deleted, more left)."""
+   last_touched = func.coalesce(Cart.updated_at, Cart.created_at)
+   purged = 0
+   chunks = 0
+   while max_chunks is None or chunks < max_chunks:
+      ids = [row[0] for row in db.session.query(Cart.id).filter(last_touched < idle_since).limit(chunk_size)]
+      if not ids:
+         return purged, False
+      CartItem.query.filter(CartItem.cart_id.in_(ids)).delete(synchronize_session=False)
+      Cart.query.filter(Cart.id.in_(ids)).delete(synchronize_session=False)
+      db.session.commit()
+      purged += len(ids)
+      chunks += 1
+   return purged, True
+
+#### Product sales stats ####
+# Scores are stored as log2(sum of weights) against a fixed epoch: weights
+# grow over time instead of old ones decaying, so ordering by the stored
+# column matches ordering by decayed score and nothing needs rewriting.
+TRENDING_EPOCH = datetime(2024, 1, 1)
+TRENDING_FLOOR = -1e6
+
+def trending_weight(quantity, at):
+   half_life = app.config['TRENDING_HALF_LIFE_HOURS'] * 3600
+   return math.log2(quantity) + (at - TRENDING_EPOCH).total_seconds() / half_life
+
+def log2_add(a, b):
+   hi, lo = max(a, b), min(a, b)
+   return hi + math.log2(1 + 2 ** (lo - hi))
+
+def log2_sub(a, b):
+   if b >= a:
+      return TRENDING_FLOOR
+   return a + math.log2(1 - 2 ** (b - a))
+
+def record_sales(lines, at=None, sign=1):
+   """Add (or with sign=-1 remove) sales to the product counters.
+
+   ``lines`` are (product_id, quantity) pairs sold at ``at``, or
+   (product_id, quantity, sold_at) triples when they span several orders.
+   """
+   quantities = {}
+   weights = {}
+   for product_id, quantity, *sold_at in lines:
+      if quantity <= 0:
+         continue
+      quantities[product_id] = quantities.get(product_id, 0) + quantity
+      weights[product_id] = log2_add(weights.get(product_id, TRENDING_FLOOR),
+                                     trending_weight(quantity, sold_at[0] if sold_at else at))
+   if not quantities:
+      return
+   stats = {s.product_id: s for s in ProductStats.query
+            .filter(ProductStats.product_id.in_(quantities))
+            .with_for_update().all()}
+   for product_id, quantity in quantities.items():
+      row = stats.get(product_id)
+      if row is None:
+         if sign < 0:
+            continue
+         row = ProductStats(product_id=product_id, units_sold=0, trending_score=TRENDING_FLOOR)
+         db.session.add(row)
+      weight = weights[product_id]
+      if sign > 0:
+         row.units_sold += quantity
+         row.trending_score = log2_add(row.trending_score, weight)
+      else:
+         row.units_sold = max(0, row.units_sold - quantity)
+         row.trending_score = log2_sub(row.trending_score, weight)
+
+def order_lines(order_id):
+   return db.session.query(OrderItem.product_id, OrderItem.quantity).filter_by(order_id=order_id).all()
+
+def rebuild_product_stats():
+   units = {}
+   scores = {}
+   rows = db.session.query(OrderItem.product_id, OrderItem.quantity, Order.created_at) \
+      .join(Order, Order.id == OrderItem.order_id) \
+      .filter(Order.status != 'cancelled', OrderItem.quantity > 0).all()
+   rows += [line[1:] for line in archived_order_lines() if line[2] > 0]
+   for product_id, quantity, created_at in rows:
+      units[product_id] = units.get(product_id, 0) + quantity
+      scores[product_id] = log2_add(scores.get(product_id, TRENDING_FLOOR), trending_weight(quantity, created_at))
+
+   ProductStats.query.delete()
+   product_ids = [row[0] for row in db.session.query(Product.id)]
+   if product_ids:
+      db.session.execute(insert(ProductStats), [{
+         'product_id': product_id,
+         'units_sold': units.get(product_id, 0),
+         'trending_score': scores.get(product_id, TRENDING_FLOOR)
+      } for product_id in product_ids])
+   # The orders just counted must not be added again by their pending jobs
+   db.session.execute(update(Order).where(Order.sales_recorded.is_(False)).values(sales_recorded=True))
+   db.session.commit()
+
+def ensure_product_stats():
+   # Ranked sorts inner-join the stats table, so every product needs a row
+   if ProductStats.query.first() is None:
+      rebuild_product_stats()
+      return
+   missing = select(Product.id, literal(0), literal(TRENDING_FLOOR)) \
+      .where(~select(ProductStats.product_id).where(ProductStats.product_id == Product.id).exists())
+   db.session.execute(insert(ProductStats).from_select(['product_id', 'units_sold', 'trending_score'], missing))
+   db.session.commit()
+
+def apply_ranked_sort(query, sort):
+   if sort == 'bestselling':
+      order = (ProductStats.units_sold.desc(), ProductStats.product_id.desc())
+   elif sort == 'trending':
+      order = (ProductStats.trending_score.desc(), ProductStats.product_id.desc())
+   else:
+      return query
+   return query.join(ProductStats, ProductStats.product_id == Product.id).order_by(*order)
+
 ####### Seed products###################
 def seed_products():
+   """Load product_data.json into an empty catalog; returns the ids added."""
    logger.info("Attempting to seed products...")
    if Product.query.count() == 0:
       current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -172,11 +663,12 @@ def seed_products():
       
       if not os.path.exists(json_file_path):
          logger.error(f"product_data.json not found at {json_file_path}")
-         return
+         return []
       
       with open(json_file_path, 'r') as f:
          products_data = json.load(f)
       
+      products = []
       for product_data in products_data:
          product = Product(
                title=product_data['title'],
@@ -188,17 +680,65 @@ def seed_products():
                rating_count=product_data['rating']['count']
          )
          db.session.add(product)
+         products.append(product)
       
       db.session.commit()
       logger.info(f"Added {len(products_data)} products to the database")
+      return [product.id for product in products]
    else:
       logger.info(f"Database already contains {Product.query.count()} products. Skipping seeding.")
+      return []
+
+def ensure_schema():
+   # create_all() skips tables that already exist, so add the nullable
+   # columns and indexes introduced since an older database was created
+   inspector = sa_inspect(db.engine)
+   preparer = db.engine.dialect.identifier_preparer
+   for table in db.metadata.sorted_tables:
+      if not inspector.has_table(table.name):
+         continue
+      existing = {column['name'] for column in inspector.get_columns(table.name)}
+      for column in table.columns:
+         if column.name not in existing and column.nullable:
+            logger.info(f"Adding column {table.name}.{column.name}")
+            db.session.execute(text(
+               f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+               f"{preparer.format_column(column)} {column.type.compile(dialect=db.engine.dialect)}"
+            ))
+      db.session.commit()
+      for index in table.indexes:
+         index.create(db.engine, checkfirst=True)
+   catalog_version = db.session.get(CatalogVersion, 1)
+   if catalog_version is None:
+      db.session.add(CatalogVersion(id=1, version=0, compacted_through=0))
+      db.session.commit()
+   elif catalog_version.compacted_through is None:
+      # Changes made before the change feed existed were never logged
+      catalog_version.compacted_through = catalog_version.version
+      db.session.commit()
+
+@contextmanager
+def init_lock():
+   # Every gunicorn worker imports the app, so take turns creating and
+   # seeding the database rather than racing to do it several times
+   if fcntl is None:
+      yield
+      return
+   os.makedirs(app.instance_path, exist_ok=True)
+   with open(os.path.join(app.instance_path, 'init_db.lock'), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(lock, fcntl.LOCK_UN)
 
 def init_db():
    logger.info("Initializing database...")
-   with app.app_context():
+   with init_lock(), app.app_context():
       db.create_all()
+      ensure_schema()
       seed_products()
+      ensure_product_stats()
    logger.info("Database initialization completed.")
 
 # Call init_db()
@@ -209,36 +749,18 @@ def make_api_request(endpoint, method='GET', data=None, params=None):
    url = f"{FAKESTORE_API_URL}/{endpoint}"
    try:
       if method == 'GET':
-         response = requests.get(url, params=params)
+         response = fakestore_session.get(url, params=params, timeout=FAKESTORE_TIMEOUT)
       elif method in ['POST', 'PUT', 'PATCH']:
-         response = requests.request(method, url, json=data)
+         response = fakestore_session.request(method, url, json=data, timeout=FAKESTORE_TIMEOUT)
       elif method == 'DELETE':
-         response = requests.delete(url)
+         response = fakestore_session.delete(url, timeout=FAKESTORE_TIMEOUT)
       response.raise_for_status()
       return response.json()
    except requests.exceptions.RequestException as e:
       return {"message": f"Error: {str(e)}"}, 500
 
-#### Products ####
-@app.route('/api/products', methods=['GET'])
-def get_products():
-   limit = request.args.get('limit', type=int)
-   sort = request.args.get('sort')
-   
-   query = Product.query
-
-   if sort:
-      if sort == 'desc':
-         query = query.order_by(Product.id.desc())
-      elif sort == 'asc':
-         query = query.order_by(Product.id.asc())
-
-   if limit:
-      query = query.limit(limit)
-
-   products = query.all()
-   
-   return jsonify([{
+def product_to_dict(p):
+   return {
       'id': p.id,
       'title': p.title,
       'price': p.price,
@@ -249,11 +771,1006 @@ def get_products():
          'rate': p.rating,
          'count': p.rating_count
       }
-   } for p in products])
+   }
+
+def profile_to_dict(user):
+   return {
+      "id": user.id,
+      "username": user.username,
+      "email": user.email,
+      "role": user.role,
+      "firstname": user.firstname,
+      "lastname": user.lastname,
+      "address": user.address,
+      "phone": user.phone
+   }
+
+def cart_to_dict(user_id):
+   cart = Cart.query.filter_by(user_id=user_id).order_by(Cart.created_at.desc()).first()
+   if not cart:
+      return None
+   # One join instead of a product lookup per cart line
+   rows = db.session.query(CartItem, Product) \
+      .join(Product, Product.id == CartItem.product_id) \
+      .filter(CartItem.cart_id == cart.id) \
+      .order_by(CartItem.id).all()
+   items = []
+   for item, product in rows:
+      description = product.description or ''
+      items.append({
+         "product_id": item.product_id,
+         "title": product.title,
+         "price": float(product.price),
+         "quantity": item.quantity,
+         "image": product.image,
+         "description": description[:100] + '...' if len(description) > 100 else description,
+         "category": product.category
+      })
+   return {
+      "id": cart.id,
+      "user_id": cart.user_id,
+      "created_at": cart.created_at.isoformat(),
+      "items": items
+   }
+
+#### Catalog cache ####
+# Per-process cache for catalog data that is the same for every user. It is
+# cleared whenever the catalog version moves (see Catalog versions below).
+catalog_cache = {}
+
+def cached_catalog(key, load):
+   sync_catalog_version()
+   entry = catalog_cache.get(key)
+   now = time.monotonic()
+   if entry and entry[0] > now:
+      return entry[1]
+   value = load()
+   catalog_cache[key] = (now + app.config['CATALOG_CACHE_TTL'], value)
+   return value
+
+def invalidate_catalog_cache():
+   catalog_cache.clear()
+
+def all_categories():
+   return cached_catalog('categories', lambda: [
+      category[0] for category in db.session.query(Product.category).distinct().all()
+   ])
+
+def featured_products(limit):
+   return cached_catalog(('featured', limit), lambda: [
+      product_to_dict(p) for p in Product.query.order_by(Product.id).limit(limit).all()
+   ])
+
+#### Related products ####
+def rebuild_related_products(top_k=None):
+   top_k = top_k or app.config['RELATED_PRODUCTS_TOP_K']
+   rows = db.session.query(OrderItem.order_id, OrderItem.product_id) \
+      .join(Order, Order.id == OrderItem.order_id) \
+      .filter(Order.status != 'cancelled').all()
+   rows += [line[:2] for line in archived_order_lines()]
+   related = top_k_cooccurrence([r[0] for r in rows], [r[1] for r in rows], k=top_k)
+
+   RelatedProduct.query.delete()
+   table = [
+      {'product_id': product_id, 'related_id': related_id, 'score': score}
+      for product_id, neighbours in related.items()
+      for related_id, score in neighbours
+   ]
+   if table:
+      db.session.execute(insert(RelatedProduct), table)
+   db.session.commit()
+   return len(related)
+
+def record_order_cooccurrence(product_ids):
+   # Incremental update between full rebuilds: pairs already in a product's
+   # top-K gain a point and new pairs fill free slots. The periodic rebuild
+   # restores exact rankings.
+   product_ids = set(product_ids)
+   if len(product_ids) < 2:
+      return
+   top_k = app.config['RELATED_PRODUCTS_TOP_K']
+   existing = {}
+   for row in RelatedProduct.query.filter(RelatedProduct.product_id.in_(product_ids)).all():
+      existing.setdefault(row.product_id, {})[row.related_id] = row
+   for product_id in product_ids:
+      neighbours = existing.get(product_id, {})
+      for related_id in product_ids - {product_id}:
+         if related_id in neighbours:
+            neighbours[related_id].score += 1
+         elif len(neighbours) < top_k:
+            neighbours[related_id] = RelatedProduct(product_id=product_id, related_id=related_id, score=1)
+            db.session.add(neighbours[related_id])
+
+#### Inventory ####
+class InsufficientStock(Exception):
+   def __init__(self, product_id):
+      super().__init__(f"Insufficient stock for product {product_id}")
+      self.product_id = product_id
+
+def take_stock(product_id, quantity):
+   # A single conditional UPDATE: the row lock lasts only until the caller
+   # commits and concurrent buyers can never drive stock below zero.
+   result = db.session.execute(
+      update(ProductInventory)
+      .where(ProductInventory.product_id == product_id, ProductInventory.stock >= quantity)
+      .values(stock=ProductInventory.stock - quantity)
+   )
+   if result.rowcount == 1:
+      return True
+   if db.session.get(ProductInventory, product_id) is None:
+      return False
+   raise InsufficientStock(product_id)
+
+def return_stock(product_id, quantity):
+   db.session.execute(
+      update(ProductInventory)
+      .where(ProductInventory.product_id == product_id)
+      .values(stock=ProductInventory.stock + quantity)
+   )
+
+def valid_stock(stock):
+   # None stops tracking stock for the product
+   return stock is None or (type(stock) is int and stock >= 0)
+
+def set_stock(product_id, stock):
+   inventory = db.session.get(ProductInventory, product_id)
+   if stock is None:
+      if inventory:
+         db.session.delete(inventory)
+   elif inventory:
+      inventory.stock = stock
+   else:
+      db.session.add(ProductInventory(product_id=product_id, stock=stock))
+
+def stock_lines(items):
+   """(product_id, quantity) pairs from request items, or None if any item is malformed."""
+   if not isinstance(items, list):
+      return None
+   lines = []
+   for item in items:
+      if not isinstance(item, dict):
+         return None
+      product_id, quantity = item.get('product_id'), item.get('quantity')
+      if type(product_id) is not int or type(quantity) is not int or quantity < 1:
+         return None
+      lines.append((product_id, quantity))
+   return lines
+
+def reserve_items(user_id, lines, expires_at=None, order_id=None):
+   # Sorted so concurrent multi-item reservations lock rows in the same order
+   quantities = {}
+   for product_id, quantity in lines:
+      quantities[product_id] = quantities.get(product_id, 0) + quantity
+   reservations = []
+   for product_id in sorted(quantities):
+      if take_stock(product_id, quantities[product_id]):
+         reservation = StockReservation(
+            user_id=user_id,
+            product_id=product_id,
+            quantity=quantities[product_id],
+            status='committed' if order_id else 'held',
+            order_id=order_id,
+            expires_at=expires_at
+         )
+         db.session.add(reservation)
+         reservations.append(reservation)
+   return reservations
+
+def release_reservation(reservation_id, from_status):
+   # Flipping the status first means a reservation is only ever returned once,
+   # even if the expiry sweep and a cancellation race for it
+   result = db.session.execute(
+      update(StockReservation)
+      .where(StockReservation.id == reservation_id, StockReservation.status == from_status)
+      .values(status='released')
+   )
+   return result.rowcount == 1
+
+def release_reservations(query, from_status, limit=None):
+   query = query.filter(StockReservation.status == from_status)
+   if limit:
+      query = query.order_by(StockReservation.expires_at).limit(limit)
+   released = 0
+   for reservation in query.all():
+      if release_reservation(reservation.id, from_status):
+         return_stock(reservation.product_id, reservation.quantity)
+         released += 1
+   return released
+
+def release_expired_reservations(limit=500):
+   expired = StockReservation.query.filter(StockReservation.expires_at < datetime.utcnow())
+   released = release_reservations(expired, 'held', limit=limit)
+   db.session.commit()
+   return released
+
+def commit_held_reservations(user_id, order_id, lines):
+   # Turn the user's checkout hold into the order's stock; any line the hold
+   # does not cover (or that expired) is reserved directly
+   quantities = {}
+   for product_id, quantity in lines:
+      quantities[product_id] = quantities.get(product_id, 0) + quantity
+   held = StockReservation.query.filter(
+      StockReservation.user_id == user_id,
+      StockReservation.status == 'held',
+      StockReservation.expires_at >= datetime.utcnow()
+   ).all()
+   for reservation in held:
+      if reservation.product_id in quantities and quantities[reservation.product_id] >= reservation.quantity:
+         result = db.session.execute(
+            update(StockReservation)
+            .where(StockReservation.id == reservation.id, StockReservation.status == 'held')
+            .values(status='committed', order_id=order_id)
+         )
+         if result.rowcount == 1:
+            quantities[reservation.product_id] -= reservation.quantity
+            continue
+      if release_reservation(reservation.id, 'held'):
+         return_stock(reservation.product_id, reservation.quantity)
+   reserve_items(user_id, [(pid, q) for pid, q in quantities.items() if q > 0], order_id=order_id)
+
+def release_order_stock(order_id):
+   return release_reservations(StockReservation.query.filter_by(order_id=order_id), 'committed')
+
+#### Order status ####
+# Orders only move forward through ORDER_FLOW (skipping steps is allowed) and
+# can be cancelled until they ship. Cancelled and delivered are final.
+ORDER_FLOW = ('pending', 'processing', 'shipped', 'delivered')
+CANCELLABLE_STATUSES = ('pending', 'processing')
+ORDER_STATUSES = ORDER_FLOW + ('cancelled',)
+ORDER_TRANSITION_CHUNK_SIZE = 500
+
+def allowed_previous_statuses(status):
+   if status == 'cancelled':
+      return CANCELLABLE_STATUSES
+   return ORDER_FLOW[:ORDER_FLOW.index(status)]
+
+def transition_orders(order_ids, status):
+   """Move orders to ``status`` with one UPDATE per chunk; the caller commits.
+
+   Returns a result per order id, in the order given: ``updated``,
+   ``unchanged`` (already there), ``invalid_transition``, ``conflict``
+   (changed concurrently) or ``not_found``.
+   """
+   allowed = allowed_previous_statuses(status)
+   order_ids = list(dict.fromkeys(order_ids))
+   previous = {}
+   moved = set()
+   for start in range(0, len(order_ids), ORDER_TRANSITION_CHUNK_SIZE):
+      chunk = order_ids[start:start + ORDER_TRANSITION_CHUNK_SIZE]
+      rows = db.session.query(Order.id, Order.status).filter(Order.id.in_(chunk)).with_for_update().all()
+      previous.update(rows)
+      eligible = [order_id for order_id, current in rows if current in allowed]
+      if not eligible:
+         continue
+      statement = update(Order).where(Order.id.in_(eligible), Order.status.in_(allowed)).values(status=status)
+      if db.engine.dialect.update_returning:
+         moved.update(db.session.scalars(statement.returning(Order.id)))
+      else:
+         # The rows are locked, so every eligible order is updated
+         db.session.execute(statement)
+         moved.update(eligible)
+
+   if moved and status == 'cancelled':
+      # Orders whose record_order_sales job has not run yet were never counted
+      lines = db.session.query(OrderItem.product_id, OrderItem.quantity, Order.created_at) \
+         .join(Order, Order.id == OrderItem.order_id) \
+         .filter(Order.id.in_(moved), or_(Order.sales_recorded.is_(None), Order.sales_recorded.is_(True)))
+      record_sales(lines.all(), sign=-1)
+      for order_id in moved:
+         release_order_stock(order_id)
+
+   results = []
+   for order_id in order_ids:
+      current = previous.get(order_id)
+      if current is None:
+         outcome = 'not_found'
+      elif order_id in moved:
+         outcome = 'updated'
+      elif current == status:
+         outcome = 'unchanged'
+      elif current in allowed:
+         outcome = 'conflict'
+      else:
+         outcome = 'invalid_transition'
+      results.append({'id': order_id, 'from': current, 'outcome': outcome})
+   return results
+
+#### Payment intents ####
+# Local copy of PaymentIntentRecord so re-renders and retries of the same
+# checkout skip both Stripe and the database
+payment_intent_cache = OrderedDict()
+payment_intent_cache_lock = threading.Lock()
+PAYMENT_INTENT_CACHE_SIZE = 10000
+
+def cart_hash(lines):
+   quantities = {}
+   for product_id, quantity in lines:
+      quantities[int(product_id)] = quantities.get(int(product_id), 0) + int(quantity)
+   canonical = ','.join(f"{pid}x{q}" for pid, q in sorted(quantities.items()) if q > 0)
+   return hashlib.sha256(canonical.encode()).hexdigest()
+
+def current_cart_lines(user_id):
+   cart = Cart.query.filter_by(user_id=user_id).order_by(Cart.created_at.desc()).first()
+   if not cart:
+      return []
+   return db.session.query(CartItem.product_id, CartItem.quantity).filter_by(cart_id=cart.id).all()
+
+def cache_payment_intent(record):
+   with payment_intent_cache_lock:
+      payment_intent_cache[(record.user_id, record.cart_hash)] = (record.intent_id, record.client_secret, record.amount)
+      payment_intent_cache.move_to_end((record.user_id, record.cart_hash))
+      while len(payment_intent_cache) > PAYMENT_INTENT_CACHE_SIZE:
+         payment_intent_cache.popitem(last=False)
+
+def forget_payment_intents(user_id):
+   # Called once an order is placed: the next checkout pays a new intent
+   PaymentIntentRecord.query.filter_by(user_id=user_id).delete()
+   with payment_intent_cache_lock:
+      for key in [k for k in payment_intent_cache if k[0] == user_id]:
+         del payment_intent_cache[key]
+
+def get_or_create_payment_intent(user_id, lines, amount, currency='usd'):
+   key_hash = cart_hash(lines)
+   with payment_intent_cache_lock:
+      cached = payment_intent_cache.get((user_id, key_hash))
+   if cached and cached[2] == amount:
+      # Another worker may have placed the order and dropped the record
+      # without being able to clear this worker's cache
+      current = db.session.query(PaymentIntentRecord.intent_id).filter_by(user_id=user_id, cart_hash=key_hash).scalar()
+      if current == cached[0]:
+         return cached[1]
+      with payment_intent_cache_lock:
+         payment_intent_cache.pop((user_id, key_hash), None)
+
+   record = PaymentIntentRecord.query.filter_by(user_id=user_id, cart_hash=key_hash).first()
+   if record and record.amount != amount:
+      revision = record.revision or 0
+      try:
+         intent = stripe.PaymentIntent.modify(
+            record.intent_id,
+            amount=amount,
+            idempotency_key=f"pi-modify-{record.intent_id}-{revision}-{amount}"
+         )
+         if intent.amount != amount:
+            raise stripe.error.InvalidRequestError(f"PaymentIntent kept amount {intent.amount}", 'amount')
+         db.session.execute(
+            update(PaymentIntentRecord)
+            .where(PaymentIntentRecord.id == record.id, func.coalesce(PaymentIntentRecord.revision, 0) == revision)
+            .values(amount=amount, revision=revision + 1)
+         )
+         db.session.commit()
+         db.session.refresh(record)
+      except stripe.error.InvalidRequestError:
+         # The intent can no longer change (paid or cancelled); open a fresh one
+         logger.info(f"Replacing payment intent {record.intent_id} for user {user_id}")
+         db.session.delete(record)
+         db.session.commit()
+         return create_recorded_payment_intent(user_id, key_hash, amount, currency, replaces=record.intent_id)
+   if record:
+      cache_payment_intent(record)
+      return record.client_secret
+   return create_recorded_payment_intent(user_id, key_hash, amount, currency)
+
+def create_recorded_payment_intent(user_id, key_hash, amount, currency, replaces=None):
+   # Concurrent requests for the same cart share one intent through the
+   # idempotency key; the unique constraint settles which row is kept. The
+   # user's latest order id keeps a repeat purchase of the same cart from
+   # replaying the already paid intent.
+   last_order_id = db.session.query(func.max(Order.id)).filter(Order.user_id == user_id).scalar() or 0
+   idempotency_key = f"pi-create-{user_id}-{key_hash}-{amount}-{last_order_id}"
+   if replaces:
+      idempotency_key += f"-after-{replaces}"
+   intent = stripe.PaymentIntent.create(
+      amount=amount,
+      currency=currency,
+      automatic_payment_methods={
+            'enabled': True,
+      },
+      metadata={'user_id': user_id, 'cart_hash': key_hash},
+      idempotency_key=idempotency_key
+   )
+   record = PaymentIntentRecord(
+      user_id=user_id,
+      cart_hash=key_hash,
+      intent_id=intent.id,
+      client_secret=intent.client_secret,
+      amount=amount,
+      currency=currency
+   )
+   db.session.add(record)
+   try:
+      db.session.commit()
+   except IntegrityError:
+      db.session.rollback()
+      record = PaymentIntentRecord.query.filter_by(user_id=user_id, cart_hash=key_hash).one()
+   cache_payment_intent(record)
+   return record.client_secret
+
+#### Background jobs ####
+# Jobs are rows in the main database, so enqueueing is part of the caller's
+# transaction: a job exists exactly when the order (or whatever) it follows
+# up on was committed. Workers are started with 'flask run-worker'.
+job_handlers = {}
+
+def job_handler(name):
+   def register(fn):
+      job_handlers[name] = fn
+      return fn
+   return register
+
+def enqueue_job(name, delay=None, max_attempts=None, **payload):
+   job = Job(
+      name=name,
+      payload=json.dumps(payload),
+      max_attempts=max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+      run_at=datetime.utcnow() + (delay or timedelta(0))
+   )
+   db.session.add(job)
+   return job
+
+def claim_job(worker_id):
+   now = datetime.utcnow()
+   due = Job.query.filter(Job.status == 'queued', Job.run_at <= now).order_by(Job.run_at, Job.id)
+   if db.engine.dialect.name in ('postgresql', 'mysql'):
+      job = due.with_for_update(skip_locked=True).first()
+      if job is None:
+         db.session.rollback()
+         return None
+      job.status = 'running'
+      job.locked_by = worker_id
+      job.started_at = now
+      job.attempts += 1
+      db.session.commit()
+      return job
+
+   # SQLite has no row locks: claim by compare-and-set on the status instead
+   for job_id in [row[0] for row in due.with_entities(Job.id).limit(5)]:
+      result = db.session.execute(
+         update(Job)
+         .where(Job.id == job_id, Job.status == 'queued')
+         .values(status='running', locked_by=worker_id, started_at=now, attempts=Job.attempts + 1)
+      )
+      db.session.commit()
+      if result.rowcount == 1:
+         return db.session.get(Job, job_id)
+   return None
+
+def run_job(job):
+   # The handler's writes and the job's completion commit together
+   job_id = job.id
+   try:
+      handler = job_handlers.get(job.name)
+      if handler is None:
+         raise LookupError(f"No handler registered for job '{job.name}'")
+      handler(**json.loads(job.payload))
+      job.status = 'done'
+      job.finished_at = datetime.utcnow()
+      job.last_error = None
+      db.session.commit()
+      return True
+   except Exception:
+      db.session.rollback()
+      job = db.session.get(Job, job_id)
+      job.last_error = traceback.format_exc()[-4000:]
+      if job.attempts >= job.max_attempts:
+         job.status = 'dead'
+         job.finished_at = datetime.utcnow()
+         logger.error(f"Job {job_id} ({job.name}) moved to dead letter after {job.attempts} attempts")
+      else:
+         backoff = min(app.config['JOB_RETRY_BASE_SECONDS'] * 2 ** (job.attempts - 1), 3600)
+         job.status = 'queued'
+         job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+      db.session.commit()
+      return False
+
+def requeue_stale_jobs():
+   # Jobs whose worker died mid-run go back to the queue once their lease lapses
+   cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+   result = db.session.execute(
+      update(Job)
+      .where(Job.status == 'running', Job.started_at < cutoff)
+      .values(status='queued', locked_by=None)
+   )
+   db.session.commit()
+   return result.rowcount
+
+def work_off_jobs(worker_id='inline', limit=None):
+   processed = 0
+   while limit is None or processed < limit:
+      job = claim_job(worker_id)
+      if job is None:
+         break
+      run_job(job)
+      processed += 1
+   return processed
+
+def job_metrics():
+   now = datetime.utcnow()
+   counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+   oldest_due = db.session.query(func.min(Job.run_at)) \
+      .filter(Job.status == 'queued', Job.run_at <= now).scalar()
+   recent = db.session.query(Job.created_at, Job.run_at, Job.started_at, Job.finished_at) \
+      .filter(Job.status == 'done', Job.finished_at >= now - timedelta(hours=1)).all()
+   waits = [(started - max(created, run_at)).total_seconds() for created, run_at, started, _ in recent]
+   runs = [(finished - started).total_seconds() for _, _, started, finished in recent]
+   return {
+      'counts': {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'dead')},
+      'due': db.session.query(func.count(Job.id)).filter(Job.status == 'queued', Job.run_at <= now).scalar(),
+      'oldest_due_age_seconds': (now - oldest_due).total_seconds() if oldest_due else 0,
+      'last_hour': {
+         'completed': len(recent),
+         'avg_wait_seconds': sum(waits) / len(waits) if waits else 0,
+         'max_wait_seconds': max(waits) if waits else 0,
+         'avg_run_seconds': sum(runs) / len(runs) if runs else 0
+      }
+   }
+
+@job_handler('record_order_cooccurrence')
+def record_order_cooccurrence_job(order_id):
+   record_order_cooccurrence(product_id for product_id, _ in order_lines(order_id))
+
+@job_handler('record_order_sales')
+def record_order_sales_job(order_id):
+   # Claiming the order first makes a retried job, or one racing a
+   # cancellation, count it at most once
+   claimed = db.session.execute(
+      update(Order)
+      .where(Order.id == order_id, Order.sales_recorded.is_(False), Order.status != 'cancelled')
+      .values(sales_recorded=True)
+   )
+   if claimed.rowcount == 1:
+      created_at = db.session.query(Order.created_at).filter_by(id=order_id).scalar()
+      record_sales(order_lines(order_id), created_at)
+
+@job_handler('rebuild_related_products')
+def rebuild_related_products_job():
+   rebuild_related_products()
+
+@job_handler('purge_idle_carts')
+def purge_idle_carts_job(days=None):
+   days = days or app.config['CART_IDLE_DAYS']
+   # A bounded slice per run keeps other jobs moving; the rest is requeued
+   _, more = purge_idle_carts(datetime.utcnow() - timedelta(days=days), max_chunks=20)
+   if more:
+      enqueue_job('purge_idle_carts', days=days)
+
+@job_handler('release_expired_reservations')
+def release_expired_reservations_job():
+   release_expired_reservations()
+
+# Enqueued by run-worker once the previous run is this old
+PERIODIC_JOBS = {
+   'release_expired_reservations': timedelta(minutes=1),
+   'rebuild_related_products': timedelta(hours=24),
+}
+
+def schedule_periodic_jobs():
+   """Enqueue each periodic job that is due; the caller commits.
+
+   Two worker processes can enqueue the same run at once. That only repeats
+   the work, and every periodic job is safe to repeat.
+   """
+   now = datetime.utcnow()
+   scheduled = []
+   for name, every in PERIODIC_JOBS.items():
+      last_run = db.session.query(func.max(Job.run_at)).filter(Job.name == name).scalar()
+      if last_run is None or last_run <= now - every:
+         enqueue_job(name)
+         scheduled.append(name)
+   return scheduled
+
+#### Typeahead index ####
+# Built in a background thread so a large catalog never holds up requests;
+# suggest answers with no matches until the index is ready.
+suggest_index = PrefixIndex()
+suggest_state = {'building': None}
+suggest_build_lock = threading.Lock()
+
+def load_suggest_rows():
+   return db.session.query(
+      Product.id, Product.title, Product.category, Product.rating, Product.rating_count
+   ).yield_per(10000)
+
+def build_suggest_index(done):
+   with app.app_context():
+      try:
+         version = db.session.query(CatalogVersion.version).filter_by(id=1).scalar()
+         suggest_index.build(load_suggest_rows())
+         # Changes committed while the rows were read are applied on top
+         if not patch_indexes_since(version):
+            suggest_index.ready = False
+      except Exception:
+         logger.exception("Typeahead index build failed")
+      finally:
+         with suggest_build_lock:
+            suggest_state['building'] = None
+         done.set()
+
+def ensure_suggest_index(wait):
+   """Start building the index if needed; True once it is ready (waiting up to ``wait`` seconds)."""
+   if suggest_index.ready:
+      return True
+   with suggest_build_lock:
+      done = suggest_state['building']
+      if done is None:
+         done = suggest_state['building'] = threading.Event()
+         threading.Thread(target=build_suggest_index, args=(done,), daemon=True).start()
+   done.wait(wait)
+   return suggest_index.ready
+
+def index_product(product):
+   # Before the first suggest or facet request there is nothing to keep in sync
+   if suggest_index.ready:
+      suggest_index.upsert(product.id, product.title, product.category, product.rating, product.rating_count)
+   if facet_index.ready:
+      facet_index.upsert(product.id, product.category, product.price, product.rating)
+
+def unindex_product(product_id):
+   if suggest_index.ready:
+      suggest_index.remove(product_id)
+   if facet_index.ready:
+      facet_index.remove(product_id)
+
+#### Facets ####
+facet_index = FacetIndex()
+
+def load_facet_rows():
+   return db.session.query(Product.id, Product.category, Product.price, Product.rating).yield_per(10000)
+
+# Sorts on sales stats, which only the database has
+RANKED_SORTS = ('bestselling', 'trending', 'popularity')
+PRODUCT_SORTS = {
+   'asc': (Product.id.asc(),),
+   'desc': (Product.id.desc(),),
+   'price_asc': (Product.price.asc(), Product.id.asc()),
+   'price_desc': (Product.price.desc(), Product.id.asc()),
+   'rating': (Product.rating.desc().nullslast(), Product.rating_count.desc().nullslast(), Product.id.asc()),
+}
+
+def product_listing(categories=None):
+   """Product list for the current request's filters, sort and paging.
+
+   With include_facets=true the response also carries the total and facet
+   counts, read from facet_index rather than the database.
+   """
+   filters = {
+      'categories': categories or request.args.getlist('category') or None,
+      'min_price': request.args.get('min_price', type=float),
+      'max_price': request.args.get('max_price', type=float),
+      'min_rating': request.args.get('min_rating', type=float),
+   }
+   sort = request.args.get('sort')
+   offset = request.args.get('offset', type=int)
+   limit = request.args.get('limit', type=int)
+   catalog = columnar_catalog() if app.config['COLUMNAR_CATALOG'] and sort not in RANKED_SORTS else None
+   if catalog is not None:
+      positions = catalog.query(sort=sort, offset=offset, limit=limit, **filters)
+      return product_list_response(catalog.rows(positions), filters)
+
+   query = Product.query
+   if filters['categories']:
+      query = query.filter(Product.category.in_(filters['categories']))
+   if filters['min_price'] is not None:
+      query = query.filter(Product.price >= filters['min_price'])
+   if filters['max_price'] is not None:
+      query = query.filter(Product.price <= filters['max_price'])
+   if filters['min_rating'] is not None:
+      query = query.filter(Product.rating >= filters['min_rating'])
+   if sort in PRODUCT_SORTS:
+      query = query.order_by(*PRODUCT_SORTS[sort])
+   else:
+      query = apply_ranked_sort(query, 'bestselling' if sort == 'popularity' else sort)
+   if offset:
+      query = query.offset(offset)
+   if limit:
+      query = query.limit(limit)
+   return product_list_response([product_to_dict(p) for p in query.all()], filters)
+
+def product_list_response(products, filters):
+   if request.args.get('include_facets', '').lower() not in ('1', 'true'):
+      return jsonify(products)
+   sync_catalog_version()
+   facet_index.build_once(load_facet_rows)
+   return jsonify({
+      'products': products,
+      'total': facet_index.count(**filters),
+      'facets': facet_index.facets(**filters)
+   })
+
+#### Columnar catalog ####
+# Optional (COLUMNAR_CATALOG=1) NumPy copy of the catalog for listing queries.
+# Each catalog version is written once as a snapshot directory that every
+# worker on the host memory-maps, so the copy is shared between processes.
+columnar_state = {'version': None, 'catalog': None, 'building': None, 'retry_at': 0.0}
+# How long a worker waits before checking again on a snapshot that another
+# process is writing (or whose build failed)
+COLUMNAR_BUILD_RETRY_SECONDS = 15
+
+def load_columnar_rows():
+   return db.session.query(
+      Product.id, Product.title, Product.price, Product.description,
+      Product.category, Product.image, Product.rating, Product.rating_count
+   ).order_by(Product.id).yield_per(10000)
+
+def columnar_snapshot_path(version):
+   # Versions are per database, so keep each database's snapshots apart
+   database = hashlib.sha1(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:12]
+   return os.path.join(app.config['COLUMNAR_CATALOG_DIR'], database, f"v{version}")
+
+def build_columnar_snapshot(version=None):
+   if version is None:
+      version = db.session.query(CatalogVersion.version).filter_by(id=1).scalar()
+   path = columnar_snapshot_path(version)
+   built = ensure_snapshot(path, load_columnar_rows)
+   prune_snapshots(os.path.dirname(path))
+   return built
+
+def build_columnar_snapshot_in_background(version):
+   def build():
+      built = False
+      with app.app_context():
+         try:
+            built = build_columnar_snapshot(version)
+         except Exception:
+            logger.exception("Columnar catalog snapshot build failed")
+         finally:
+            if not built:
+               columnar_state['retry_at'] = time.monotonic() + COLUMNAR_BUILD_RETRY_SECONDS
+            columnar_state['building'] = None
+   columnar_state['building'] = version
+   threading.Thread(target=build, daemon=True).start()
+
+def columnar_catalog():
+   version = sync_catalog_version()
+   if version is None:
+      return None
+   if columnar_state['version'] == version:
+      return columnar_state['catalog']
+   path = columnar_snapshot_path(version)
+   if not os.path.isdir(path):
+      # Listings use SQL until the snapshot for this version is ready
+      if columnar_state['building'] != version and time.monotonic() >= columnar_state['retry_at']:
+         build_columnar_snapshot_in_background(version)
+      return None
+   catalog = ColumnarCatalog.load(path)
+   columnar_state.update(version=version, catalog=catalog)
+   return catalog
+
+#### Catalog versions ####
+# Workers compare the stored version with the one their caches, typeahead and
+# facet indexes were built from, at most once per CATALOG_VERSION_CHECK_SECONDS.
+catalog_state = {'version': None, 'checked_at': 0.0}
+# Larger changes rebuild the indexes instead of patching them row by row
+INDEX_PATCH_LIMIT = 200
+
+def bump_catalog_version(changed_ids=(), deleted_ids=()):
+   """Take the next catalog version and stamp the products it touches; the caller commits."""
+   # The version row stays locked until commit, so stamps are applied in version order
+   db.session.execute(
+      update(CatalogVersion)
+      .where(CatalogVersion.id == 1)
+      .values(version=CatalogVersion.version + 1, updated_at=datetime.utcnow())
+   )
+   version = db.session.query(CatalogVersion.version).filter_by(id=1).scalar()
+   stamps = dict.fromkeys(changed_ids, False)
+   stamps.update(dict.fromkeys(deleted_ids, True))
+   product_ids = list(stamps)
+   now = datetime.utcnow()
+   for start in range(0, len(product_ids), 500):
+      chunk = product_ids[start:start + 500]
+      logged = {row[0] for row in db.session.query(CatalogChange.product_id).filter(CatalogChange.product_id.in_(chunk))}
+      rows = [{'product_id': pid, 'version': version, 'deleted': stamps[pid], 'changed_at': now} for pid in chunk]
+      if logged:
+         db.session.execute(update(CatalogChange), [row for row in rows if row['product_id'] in logged])
+      if len(logged) < len(rows):
+         db.session.execute(insert(CatalogChange), [row for row in rows if row['product_id'] not in logged])
+   return version
+
+def compact_catalog_changes(older_than):
+   """Drop tombstones older than ``older_than``; feed clients that may have missed them must resync."""
+   expired = CatalogChange.query.filter(CatalogChange.deleted.is_(True), CatalogChange.changed_at < older_than)
+   newest = expired.with_entities(func.max(CatalogChange.version)).scalar()
+   if newest is None:
+      return 0
+   removed = expired.delete(synchronize_session=False)
+   db.session.execute(
+      update(CatalogVersion)
+      .where(CatalogVersion.id == 1, func.coalesce(CatalogVersion.compacted_through, 0) < newest)
+      .values(compacted_through=newest)
+   )
+   db.session.commit()
+   return removed
+
+def reset_catalog_derivatives():
+   invalidate_catalog_cache()
+   # Rebuilt on their next use
+   suggest_index.ready = False
+   facet_index.ready = False
+
+def patch_indexes(changed_ids, deleted_ids=()):
+   for product_id in deleted_ids:
+      unindex_product(product_id)
+   if changed_ids and (suggest_index.ready or facet_index.ready):
+      found = set()
+      for product in Product.query.filter(Product.id.in_(changed_ids)):
+         index_product(product)
+         found.add(product.id)
+      # Deleted since the change was logged
+      for product_id in set(changed_ids) - found:
+         unindex_product(product_id)
+
+def patch_indexes_since(version):
+   """Apply the changes logged after catalog ``version`` to the indexes; False if there are too many."""
+   compacted_through = db.session.query(CatalogVersion.compacted_through).filter_by(id=1).scalar() or 0
+   if version < compacted_through:
+      # Tombstones this worker needs may be gone
+      return False
+   changes = db.session.query(CatalogChange.product_id, CatalogChange.deleted) \
+      .filter(CatalogChange.version > version).limit(INDEX_PATCH_LIMIT + 1).all()
+   if len(changes) > INDEX_PATCH_LIMIT:
+      return False
+   patch_indexes([pid for pid, deleted in changes if not deleted], [pid for pid, deleted in changes if deleted])
+   return True
+
+def sync_catalog_version():
+   now = time.monotonic()
+   if now - catalog_state['checked_at'] < app.config['CATALOG_VERSION_CHECK_SECONDS']:
+      return catalog_state['version']
+   version = db.session.query(CatalogVersion.version).filter_by(id=1).scalar()
+   catalog_state['checked_at'] = now
+   if version != catalog_state['version']:
+      if catalog_state['version'] is not None:
+         # Another worker changed the catalog; follow its logged changes
+         invalidate_catalog_cache()
+         if not patch_indexes_since(catalog_state['version']):
+            reset_catalog_derivatives()
+      catalog_state['version'] = version
+   return version
+
+def publish_catalog_change(version, changed_ids=None, deleted_ids=()):
+   # Called after the commit that bumped the version to ``version``. When this
+   # worker was current just before, its indexes are patched in place; when
+   # it was further behind it catches up from the change log. Otherwise (or
+   # when the changed ids are unknown) everything is rebuilt.
+   invalidate_catalog_cache()
+   patchable = changed_ids is not None and len(changed_ids) + len(deleted_ids) <= INDEX_PATCH_LIMIT
+   if patchable and catalog_state['version'] == version - 1:
+      patch_indexes(changed_ids, deleted_ids)
+   elif catalog_state['version'] is None or not patch_indexes_since(catalog_state['version']):
+      suggest_index.ready = False
+      facet_index.ready = False
+   catalog_state['version'] = version
+   catalog_state['checked_at'] = time.monotonic()
+
+def import_product_chunk(rows, summary, fail, changed_ids, dry_run=False):
+   ids = {values['id'] for _, values in rows if 'id' in values}
+   skus = {values['sku'] for _, values in rows if 'sku' in values}
+   known_ids = {row[0] for row in db.session.query(Product.id).filter(Product.id.in_(ids))} if ids else set()
+   id_by_sku = dict(db.session.query(Product.sku, Product.id).filter(Product.sku.in_(skus))) if skus else {}
+
+   updates = {}
+   inserts = {}
+   stock = {}
+   for number, values in rows:
+      fields = {k: v for k, v in values.items() if k not in ('id', 'stock')}
+      if 'id' in values:
+         product_id = values['id']
+         if product_id not in known_ids:
+            fail(number, [f"Product {product_id} does not exist"])
+            continue
+         if id_by_sku.get(values.get('sku'), product_id) != product_id:
+            fail(number, [f"SKU {values['sku']} belongs to product {id_by_sku[values['sku']]}"])
+            continue
+      elif values['sku'] in id_by_sku:
+         product_id = id_by_sku[values['sku']]
+      else:
+         # Later rows for the same new SKU refine the same product
+         pending = inserts.setdefault(values['sku'], {'number': number, 'fields': {}, 'stock': None})
+         pending['fields'].update(fields)
+         pending['stock'] = values.get('stock', pending['stock'])
+         continue
+      updates.setdefault(product_id, {}).update(fields)
+      if 'stock' in values:
+         stock[product_id] = values['stock']
+
+   new_rows = []
+   for pending in inserts.values():
+      if 'title' not in pending['fields'] or 'price' not in pending['fields']:
+         fail(pending['number'], ['title and price are required for new products'])
+         continue
+      new_rows.append((dict({field: None for field in PRODUCT_FIELDS}, **pending['fields']), pending['stock']))
+
+   if updates:
+      db.session.execute(update(Product), [dict(fields, id=product_id) for product_id, fields in updates.items()])
+   new_ids = []
+   if new_rows:
+      new_ids = db.session.scalars(
+         insert(Product).returning(Product.id, sort_by_parameter_order=True),
+         [fields for fields, _ in new_rows]
+      ).all()
+      db.session.execute(insert(ProductStats), [
+         {'product_id': product_id, 'units_sold': 0, 'trending_score': TRENDING_FLOOR} for product_id in new_ids
+      ])
+      stock.update({product_id: s for product_id, (_, s) in zip(new_ids, new_rows) if s is not None})
+   if stock:
+      tracked = {row[0] for row in db.session.query(ProductInventory.product_id).filter(ProductInventory.product_id.in_(stock))}
+      if tracked:
+         db.session.execute(update(ProductInventory), [{'product_id': pid, 'stock': stock[pid]} for pid in tracked])
+      untracked = [{'product_id': pid, 'stock': s} for pid, s in stock.items() if pid not in tracked]
+      if untracked:
+         db.session.execute(insert(ProductInventory), untracked)
+
+   summary['created'] += len(new_ids)
+   summary['updated'] += len(updates)
+   if dry_run:
+      db.session.rollback()
+   else:
+      db.session.commit()
+      changed_ids.extend(updates)
+      changed_ids.extend(new_ids)
+
+#### Products ####
+@app.route('/api/products', methods=['GET'])
+def get_products():
+   return product_listing()
+
+CATALOG_CHANGES_PAGE_SIZE = 1000
+
+@app.route('/api/products/changes', methods=['GET'])
+def get_catalog_changes():
+   """Products changed and deleted after catalog version ``since``.
+
+   Clients keep the returned ``version`` and pass it as ``since`` next time.
+   With ``full_resync`` they reload /api/products instead and carry on from
+   the ``version`` in that response. Pages within one call are continued
+   with the ``next`` parameters.
+   """
+   since = request.args.get('since', type=int)
+   after_id = request.args.get('after_id', type=int)
+   if since is None or since < 0:
+      return jsonify({"message": "since must be a catalog version"}), 400
+   limit = request.args.get('limit', CATALOG_CHANGES_PAGE_SIZE, type=int)
+   if limit < 1:
+      return jsonify({"message": "limit must be at least 1"}), 400
+   limit = min(limit, CATALOG_CHANGES_PAGE_SIZE)
+
+   catalog_version = db.session.get(CatalogVersion, 1)
+   # Also resync clients ahead of us, e.g. after the database was restored
+   if since > catalog_version.version or \
+         (since <= (catalog_version.compacted_through or 0) and since < catalog_version.version):
+      response = jsonify({'version': catalog_version.version, 'full_resync': True})
+   else:
+      newer = CatalogChange.version > since
+      if after_id is not None:
+         # Continuing a page that stopped part way through version ``since``
+         newer = or_(newer, (CatalogChange.version == since) & (CatalogChange.product_id > after_id))
+      rows = db.session.query(CatalogChange, Product) \
+         .outerjoin(Product, Product.id == CatalogChange.product_id) \
+         .filter(newer) \
+         .order_by(CatalogChange.version, CatalogChange.product_id) \
+         .limit(limit + 1).all()
+      page = rows[:limit]
+      body = {
+         'version': catalog_version.version,
+         'full_resync': False,
+         'changes': [dict(product_to_dict(product), version=change.version)
+                     for change, product in page if product is not None and not change.deleted],
+         'deleted': [{'id': change.product_id, 'version': change.version}
+                     for change, product in page if product is None or change.deleted],
+         'has_more': len(rows) > limit
+      }
+      if body['has_more']:
+         last = page[-1][0]
+         body['next'] = {'since': last.version, 'after_id': last.product_id}
+      response = jsonify(body)
+   # Every client at the same version asks the same question, so let edge caches share answers briefly
+   response.headers['Cache-Control'] = 'public, max-age=5'
+   return response
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
    product = Product.query.get_or_404(product_id)
+   inventory = db.session.get(ProductInventory, product_id)
    return jsonify({
       'id': product.id,
       'title': product.title,
@@ -264,33 +1781,42 @@ def get_product(product_id):
       'rating': {
          'rate': product.rating,
          'count': product.rating_count
-      }
+      },
+      'stock': inventory.stock if inventory else None
    })
 
+@app.route('/api/products/<int:product_id>/related', methods=['GET'])
+def get_related_products(product_id):
+   product = Product.query.get_or_404(product_id)
+   limit = min(request.args.get('limit', 4, type=int), app.config['RELATED_PRODUCTS_TOP_K'])
+
+   related = Product.query.join(RelatedProduct, RelatedProduct.related_id == Product.id) \
+      .filter(RelatedProduct.product_id == product_id) \
+      .order_by(RelatedProduct.score.desc(), Product.id) \
+      .limit(limit).all()
+
+   # Products without purchase history fall back to the best rated in their category
+   if len(related) < limit and product.category:
+      exclude = [product_id] + [p.id for p in related]
+      related += Product.query.filter(Product.category == product.category, Product.id.notin_(exclude)) \
+         .order_by(Product.rating.desc().nullslast(), Product.rating_count.desc().nullslast(), Product.id) \
+         .limit(limit - len(related)).all()
+
+   return jsonify([product_to_dict(p) for p in related])
+
 @app.route('/api/products/categories', methods=['GET'])
 def get_categories():
-   categories = db.session.query(Product.category).distinct().all()
-   return jsonify([category[0] for category in categories])
+   return jsonify(all_categories())
 
 @app.route('/api/products/category/<category>', methods=['GET'])
+@coalesce_requests
 def get_products_in_category(category):
-   products = Product.query.filter_by(category=category).all()
-   return jsonify([{
-      'id': p.id,
-      'title': p.title,
-      'price': p.price,
-      'description': p.description,
-      'category': p.category,
-      'image': p.image,
-      'rating': {
-         'rate': p.rating,
-         'count': p.rating_count
-      }
-   } for p in products])
+   return product_listing([category])
 
 ##### Search ##########
 
 @app.route('/api/products/search', methods=['GET'])
+@coalesce_requests
 def search_products():
    query = request.args.get('q', '')
    category = request.args.get('category', '')
@@ -327,13 +1853,61 @@ def search_products():
       }
    } for p in products])
 
+@app.route('/api/products/suggest', methods=['GET'])
+def suggest_products():
+   query = request.args.get('q', '')
+   limit = min(request.args.get('limit', 8, type=int), 20)
+   sync_catalog_version()
+   if ensure_suggest_index(app.config['SUGGEST_BUILD_WAIT_SECONDS']):
+      products, categories = suggest_index.suggest(query, limit=limit)
+   else:
+      products, categories = [], []
+   return jsonify({
+      'query': query,
+      'products': [{
+         'id': product_id,
+         'title': doc['title'],
+         'category': doc['category'],
+         'rating': {
+            'rate': doc['rating'],
+            'count': doc['rating_count']
+         }
+      } for product_id, doc in products],
+      'categories': categories
+   })
+
 @app.route('/api/all-categories', methods=['GET'])
 def get_all_categories():
-   categories = db.session.query(Product.category).distinct().all()
-   return jsonify([category[0] for category in categories])
+   return jsonify(all_categories())
+
+BOOTSTRAP_FIELDS = ('profile', 'cart', 'categories', 'featured')
+
+@app.route('/api/bootstrap', methods=['GET'])
+@jwt_required(optional=True)
+def bootstrap():
+   requested = request.args.get('fields')
+   fields = [f.strip() for f in requested.split(',')] if requested else list(BOOTSTRAP_FIELDS)
+   unknown = [f for f in fields if f not in BOOTSTRAP_FIELDS]
+   if unknown:
+      return jsonify({"message": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+   current_user_id = get_jwt_identity()
+   response = {}
+   if 'profile' in fields:
+      user = db.session.get(User, current_user_id) if current_user_id else None
+      response['profile'] = profile_to_dict(user) if user else None
+   if 'cart' in fields:
+      cart = cart_to_dict(current_user_id) if current_user_id else None
+      response['cart'] = cart or {"items": []}
+   if 'categories' in fields:
+      response['categories'] = all_categories()
+   if 'featured' in fields:
+      response['featured'] = featured_products(max(1, min(request.args.get('featured_limit', 3, type=int), 50)))
+   return jsonify(response), 200
 
 #### Carts ####
 @app.route('/api/carts', methods=['GET', 'POST'])
+@coalesce_requests
 def handle_carts():
    if request.method == 'GET':
       limit = request.args.get('limit')
@@ -354,6 +1928,7 @@ def handle_carts():
       return jsonify(make_api_request('carts', method='POST', data=request.json))
 
 @app.route('/api/carts/<int:cart_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+@coalesce_requests
 def handle_cart(cart_id):
    if request.method == 'GET':
       return jsonify(make_api_request(f'carts/{cart_id}'))
@@ -363,12 +1938,14 @@ def handle_cart(cart_id):
       return jsonify(make_api_request(f'carts/{cart_id}', method='DELETE'))
 
 @app.route('/api/carts/user/<int:user_id>', methods=['GET'])
+@coalesce_requests
 def get_user_carts(user_id):
    return jsonify(make_api_request(f'carts/user/{user_id}'))
 
 #### Users ####
 @app.route('/api/users', methods=['GET', 'POST'])
 @jwt_required()
+@coalesce_requests
 def handle_users():
    if request.method == 'GET':
       limit = request.args.get('limit')
@@ -384,6 +1961,7 @@ def handle_users():
 
 @app.route('/api/users/<int:user_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
 @jwt_required()
+@coalesce_requests
 def handle_user(user_id):
    if request.method == 'GET':
       return jsonify(make_api_request(f'users/{user_id}'))
@@ -399,16 +1977,7 @@ def get_user_profile():
    user = User.query.get(current_user_id)
    if not user:
       return jsonify({"message": "User not found"}), 404
-   return jsonify({
-      "id": user.id,
-      "username": user.username,
-      "email": user.email,
-      "role": user.role,
-      "firstname": user.firstname,
-      "lastname": user.lastname,
-      "address": user.address,
-      "phone": user.phone
-   }), 200
+   return jsonify(profile_to_dict(user)), 200
 
 @app.route('/api/user/profile', methods=['PUT'])
 @jwt_required()
@@ -453,20 +2022,13 @@ def change_password():
 def get_user_orders():
    current_user_id = get_jwt_identity()
    orders = Order.query.filter_by(user_id=current_user_id).order_by(Order.created_at.desc()).all()
+   archived = ArchivedOrder.query.filter_by(user_id=current_user_id).order_by(ArchivedOrder.created_at.desc()).all()
    
-   return jsonify([{
-      'id': order.id,
-      'total_amount': order.total_amount,
-      'status': order.status,
-      'shipping_address': order.shipping_address,
-      'created_at': order.created_at.isoformat(),
-      'items': [{
-         'product_id': item.product_id,
-         'quantity': item.quantity,
-         'price': item.price,
-         'title': item.title
-      } for item in OrderItem.query.filter_by(order_id=order.id).all()]
-   } for order in orders]), 200
+   # Only finished orders are archived, so an older open order can still be live
+   history = [(order.created_at, order_to_dict(order, OrderItem.query.filter_by(order_id=order.id).all())) for order in orders]
+   history += [(row.created_at, archived_order_to_dict(row)) for row in archived]
+   history.sort(key=lambda entry: entry[0], reverse=True)
+   return jsonify([order for _, order in history]), 200
 
 #### Authentication routes ####
 @app.route('/api/auth/login', methods=['POST'])
@@ -538,34 +2100,10 @@ def manage_user_cart():
    current_user_id = get_jwt_identity()
    
    if request.method == 'GET':
-      cart = Cart.query.filter_by(user_id=current_user_id).order_by(Cart.created_at.desc()).first()
+      cart = cart_to_dict(current_user_id)
       if not cart:
          return jsonify({"message": "Cart is empty", "items": []}), 200
-      
-      cart_items = CartItem.query.filter_by(cart_id=cart.id).all()
-      items = []
-      for item in cart_items:
-         # Fetch product details from our database instead of FakeStore API
-         product = Product.query.get(item.product_id)
-         if product:
-            items.append({
-               "product_id": item.product_id,
-               "title": product.title,
-               "price": float(product.price),
-               "quantity": item.quantity,
-               "image": product.image,
-               "description": product.description[:100] + '...' if len(product.description) > 100 else product.description,
-               "category": product.category
-            })
-         else:
-            print(f"Failed to fetch product {item.product_id} from database")
-
-      return jsonify({
-         "id": cart.id,
-         "user_id": cart.user_id,
-         "created_at": cart.created_at.isoformat(),
-         "items": items
-      }), 200
+      return jsonify(cart), 200
 
    elif request.method == 'POST':
       data = request.json
@@ -590,6 +2128,7 @@ def manage_user_cart():
       else:
          cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
          db.session.add(cart_item)
+      cart.updated_at = datetime.utcnow()
 
       db.session.commit()
 
@@ -626,6 +2165,7 @@ def manage_user_cart():
          db.session.delete(cart_item)
       else:
          cart_item.quantity = quantity
+      cart.updated_at = datetime.utcnow()
 
       db.session.commit()
       return jsonify({"message": "Cart updated successfully"}), 200
@@ -643,22 +2183,21 @@ def manage_user_cart():
 @jwt_required()
 def create_payment_intent():
    try:
+      current_user_id = get_jwt_identity()
       data = request.json
       amount = int(data.get('amount', 0))  # Amount should be in cents
 
       if amount <= 0:
          return jsonify({"error": "Invalid amount"}), 400
 
-      intent = stripe.PaymentIntent.create(
-         amount=amount,
-         currency='usd',
-         automatic_payment_methods={
-               'enabled': True,
-         },
-      )
+      if data.get('items') is not None:
+         lines = [(item['product_id'], item['quantity']) for item in data['items']]
+      else:
+         lines = current_cart_lines(current_user_id)
+      client_secret = get_or_create_payment_intent(current_user_id, lines, amount)
 
       return jsonify({
-         'clientSecret': intent.client_secret
+         'clientSecret': client_secret
       })
    except stripe.error.StripeError as e:
       return jsonify(error=str(e)), 403
@@ -666,19 +2205,60 @@ def create_payment_intent():
       app.logger.error(f"Error creating payment intent: {str(e)}")
       return jsonify(error="An unexpected error occurred"), 500
 
+@app.route('/api/checkout/reserve', methods=['POST', 'DELETE'])
+@jwt_required()
+def reserve_checkout_stock():
+   current_user_id = get_jwt_identity()
+   # A new checkout attempt replaces the user's previous hold
+   release_reservations(StockReservation.query.filter_by(user_id=current_user_id), 'held')
+   if request.method == 'DELETE':
+      db.session.commit()
+      return jsonify({"message": "Reservation released"}), 200
+
+   items = (request.json or {}).get('items')
+   if items is None:
+      cart = Cart.query.filter_by(user_id=current_user_id).order_by(Cart.created_at.desc()).first()
+      items = [{'product_id': item.product_id, 'quantity': item.quantity}
+               for item in CartItem.query.filter_by(cart_id=cart.id)] if cart else []
+   if not items:
+      db.session.commit()
+      return jsonify({"message": "No items to reserve"}), 400
+   lines = stock_lines(items)
+   if lines is None:
+      db.session.rollback()
+      return jsonify({"message": "Each item needs an integer product_id and a positive integer quantity"}), 400
+
+   expires_at = datetime.utcnow() + app.config['STOCK_RESERVATION_TTL']
+   try:
+      reservations = reserve_items(current_user_id, lines, expires_at=expires_at)
+      db.session.commit()
+   except InsufficientStock as e:
+      db.session.rollback()
+      return jsonify({"message": str(e), "product_id": e.product_id}), 409
+
+   release_expired_reservations()
+   return jsonify({
+      'expires_at': expires_at.isoformat(),
+      'items': [{'product_id': r.product_id, 'quantity': r.quantity} for r in reservations]
+   }), 201
+
 @app.route('/api/orders', methods=['POST'])
 @jwt_required()
 def create_order():
    current_user_id = get_jwt_identity()
    data = request.json
+   lines = stock_lines(data.get('items'))
+   if not lines:
+      return jsonify({"message": "Each item needs an integer product_id and a positive integer quantity"}), 400
 
    new_order = Order(
       user_id=current_user_id,
       total_amount=data['total_amount'],
-      shipping_address=data['shipping_address']
+      shipping_address=data['shipping_address'],
+      sales_recorded=False
    )
    db.session.add(new_order)
-   db.session.commit()
+   db.session.flush()
 
    for item in data['items']:
       order_item = OrderItem(
@@ -689,7 +2269,17 @@ def create_order():
          title=item.get('title', '')
       )
       db.session.add(order_item)
-   
+
+   try:
+      commit_held_reservations(current_user_id, new_order.id, lines)
+   except InsufficientStock as e:
+      db.session.rollback()
+      return jsonify({"message": str(e), "product_id": e.product_id}), 409
+
+   enqueue_job('record_order_cooccurrence', order_id=new_order.id)
+   enqueue_job('record_order_sales', order_id=new_order.id)
+   # In the order's transaction, so a repeat checkout can never be handed the intent this order paid
+   forget_payment_intents(current_user_id)
    db.session.commit()
 
    return jsonify({'message': 'Order created successfully', 'order_id': new_order.id}), 201
@@ -701,23 +2291,14 @@ def get_order(order_id):
    order = Order.query.filter_by(id=order_id, user_id=current_user_id).first()
    
    if not order:
+      archived = ArchivedOrder.query.filter_by(id=order_id, user_id=current_user_id).first()
+      if archived:
+         return jsonify(archived_order_to_dict(archived)), 200
       return jsonify({'message': 'Order not found'}), 404
 
    order_items = OrderItem.query.filter_by(order_id=order.id).all()
    
-   return jsonify({
-      'id': order.id,
-      'total_amount': order.total_amount,
-      'status': order.status,
-      'shipping_address': order.shipping_address,
-      'created_at': order.created_at.isoformat(),
-      'items': [{
-         'product_id': item.product_id,
-         'quantity': item.quantity,
-         'price': item.price,
-         'title': item.title 
-      } for item in order_items]
-   }), 200
+   return jsonify(order_to_dict(order, order_items)), 200
 
 @app.route('/api/orders/<int:order_id>/cancel', methods=['POST'])
 @jwt_required()
@@ -728,15 +2309,72 @@ def cancel_order(order_id):
    if not order:
       abort(404, description="Order not found")
    
-   if order.status not in ['pending', 'processing']:
+   if transition_orders([order.id], 'cancelled')[0]['outcome'] != 'updated':
       abort(400, description="Order cannot be cancelled")
-   
-   order.status = 'cancelled'
    db.session.commit()
    
    return jsonify({'message': 'Order cancelled successfully'}), 200
 
 #### Admin routes ####
+BULK_IMPORT_TYPES = ('text/csv', 'application/x-ndjson', 'application/ndjson', 'application/jsonl')
+MAX_REPORTED_IMPORT_ERRORS = 1000
+
+@app.route('/api/admin/products/bulk', methods=['POST'])
+@jwt_required()
+@admin_required
+def admin_products_bulk():
+   if request.mimetype not in BULK_IMPORT_TYPES:
+      return jsonify({"message": f"Upload CSV or NDJSON ({', '.join(BULK_IMPORT_TYPES)})"}), 415
+   dry_run = request.args.get('dry_run', '').lower() in ('1', 'true')
+   chunk_size = app.config['BULK_IMPORT_CHUNK_SIZE']
+
+   summary = {'processed': 0, 'created': 0, 'updated': 0, 'failed': 0}
+   errors = []
+   changed_ids = []
+
+   def fail(number, messages):
+      summary['failed'] += 1
+      if len(errors) < MAX_REPORTED_IMPORT_ERRORS:
+         errors.append({'row': number, 'errors': messages})
+
+   def apply(chunk):
+      try:
+         import_product_chunk(chunk, summary, fail, changed_ids, dry_run=dry_run)
+      except (IntegrityError, DataError) as e:
+         db.session.rollback()
+         for number, _ in chunk:
+            fail(number, [f"Chunk rejected by the database: {e.orig}"])
+
+   # One version bump for the whole upload, so caches and the typeahead
+   # index are refreshed once rather than per product. Chunks are committed
+   # as they go, so the bump also runs if a later chunk fails.
+   version = None
+   try:
+      chunk = []
+      for number, row, error in iter_rows(request.stream, request.mimetype):
+         summary['processed'] += 1
+         if error:
+            fail(number, [error])
+            continue
+         values, messages = validate_row(row)
+         if messages:
+            fail(number, messages)
+            continue
+         chunk.append((number, values))
+         if len(chunk) >= chunk_size:
+            apply(chunk)
+            chunk = []
+      if chunk:
+         apply(chunk)
+   finally:
+      if changed_ids and not dry_run:
+         db.session.rollback()
+         version = bump_catalog_version(changed_ids)
+         db.session.commit()
+         publish_catalog_change(version, changed_ids)
+
+   return jsonify(dict(summary, version=version, dry_run=dry_run, errors=errors)), 200
+
 @app.route('/api/admin/products', methods=['GET', 'POST'])
 @jwt_required()
 @admin_required
@@ -746,15 +2384,26 @@ def admin_products():
       return jsonify(products_schema.dump(products))
    elif request.method == 'POST':
       data = request.json
+      if not valid_stock(data.get('stock')):
+         return jsonify({"message": "stock must be a non-negative integer or null"}), 400
+      if data.get('sku') and Product.query.filter_by(sku=data['sku']).first():
+         return jsonify({"message": "SKU already in use"}), 400
       new_product = Product(
          title=data['title'],
          price=data['price'],
          description=data.get('description'),
          category=data.get('category'),
-         image=data.get('image')
+         image=data.get('image'),
+         sku=data.get('sku')
       )
       db.session.add(new_product)
+      db.session.flush()
+      db.session.add(ProductStats(product_id=new_product.id, units_sold=0, trending_score=TRENDING_FLOOR))
+      if data.get('stock') is not None:
+         set_stock(new_product.id, data['stock'])
+      version = bump_catalog_version([new_product.id])
       db.session.commit()
+      publish_catalog_change(version, [new_product.id])
       return jsonify(product_schema.dump(new_product)), 201
 
 @app.route('/api/admin/products/<int:product_id>', methods=['PUT', 'DELETE'])
@@ -764,16 +2413,33 @@ def admin_product(product_id):
    product = Product.query.get_or_404(product_id)
    if request.method == 'PUT':
       data = request.json
+      if not valid_stock(data.get('stock')):
+         return jsonify({"message": "stock must be a non-negative integer or null"}), 400
       product.title = data.get('title', product.title)
       product.price = data.get('price', product.price)
       product.description = data.get('description', product.description)
       product.category = data.get('category', product.category)
       product.image = data.get('image', product.image)
+      if data.get('sku') and data['sku'] != product.sku:
+         if Product.query.filter_by(sku=data['sku']).first():
+            return jsonify({"message": "SKU already in use"}), 400
+         product.sku = data['sku']
+      if 'stock' in data:
+         set_stock(product.id, data['stock'])
+      version = bump_catalog_version([product.id])
       db.session.commit()
+      publish_catalog_change(version, [product.id])
       return jsonify(product_schema.dump(product))
    elif request.method == 'DELETE':
       db.session.delete(product)
+      RelatedProduct.query.filter(
+         or_(RelatedProduct.product_id == product_id, RelatedProduct.related_id == product_id)
+      ).delete(synchronize_session=False)
+      ProductStats.query.filter_by(product_id=product_id).delete()
+      ProductInventory.query.filter_by(product_id=product_id).delete()
+      version = bump_catalog_version(deleted_ids=[product_id])
       db.session.commit()
+      publish_catalog_change(version, [], [product_id])
       return '', 204
 
 @app.route('/api/admin/orders', methods=['GET'])
@@ -789,14 +2455,65 @@ def admin_orders():
       'created_at': order.created_at
    } for order in orders])
 
+MAX_BULK_ORDER_TRANSITIONS = 10000
+
+@app.route('/api/admin/orders/bulk-status', methods=['POST'])
+@jwt_required()
+@admin_required
+def bulk_update_order_status():
+   data = request.json or {}
+   status = data.get('status')
+   if status not in ORDER_STATUSES:
+      return jsonify({"message": f"status must be one of {', '.join(ORDER_STATUSES)}"}), 400
+
+   if 'ids' in data:
+      ids = data['ids']
+      if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+         return jsonify({"message": "ids must be a list of order ids"}), 400
+   elif isinstance(data.get('filter'), dict):
+      criteria = data['filter']
+      query = db.session.query(Order.id)
+      try:
+         if criteria.get('status'):
+            query = query.filter(Order.status == criteria['status'])
+         if criteria.get('user_id') is not None:
+            query = query.filter(Order.user_id == int(criteria['user_id']))
+         if criteria.get('created_after'):
+            query = query.filter(Order.created_at >= datetime.fromisoformat(criteria['created_after']))
+         if criteria.get('created_before'):
+            query = query.filter(Order.created_at < datetime.fromisoformat(criteria['created_before']))
+      except (TypeError, ValueError):
+         return jsonify({"message": "Invalid filter"}), 400
+      ids = [row[0] for row in query.order_by(Order.id).limit(MAX_BULK_ORDER_TRANSITIONS + 1)]
+   else:
+      return jsonify({"message": "Provide ids or a filter"}), 400
+
+   if len(ids) > MAX_BULK_ORDER_TRANSITIONS:
+      return jsonify({"message": f"At most {MAX_BULK_ORDER_TRANSITIONS} orders per request"}), 400
+
+   results = transition_orders(ids, status)
+   db.session.commit()
+   return jsonify({
+      'status': status,
+      'updated': sum(1 for r in results if r['outcome'] == 'updated'),
+      'results': results
+   }), 200
+
 @app.route('/api/admin/orders/<int:order_id>', methods=['PUT'])
 @jwt_required()
 @admin_required
 def update_order_status(order_id):
    order = Order.query.get_or_404(order_id)
    data = request.json
-   order.status = data.get('status', order.status)
+   status = data.get('status', order.status)
+   if status not in ORDER_STATUSES:
+      return jsonify({"message": f"Unknown status {status}"}), 400
+   result = transition_orders([order.id], status)[0]
+   if result['outcome'] not in ('updated', 'unchanged'):
+      db.session.rollback()
+      return jsonify({"message": f"Cannot move a {result['from']} order to {status}"}), 400
    db.session.commit()
+   db.session.refresh(order)
    return jsonify({
       'id': order.id,
       'user_id': order.user_id,
@@ -805,6 +2522,47 @@ def update_order_status(order_id):
       'created_at': order.created_at
    })
 
+@app.route('/api/admin/single-flight/metrics', methods=['GET'])
+@jwt_required()
+@admin_required
+def admin_single_flight_metrics():
+   return jsonify(request_flight.metrics())
+
+@app.route('/api/admin/jobs/metrics', methods=['GET'])
+@jwt_required()
+@admin_required
+def admin_job_metrics():
+   return jsonify(job_metrics())
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@jwt_required()
+@admin_required
+def admin_profiles():
+   return jsonify(profile_store.list(limit=min(request.args.get('limit', 50, type=int), 500)))
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@jwt_required()
+@admin_required
+def admin_profile_download(profile_id):
+   path = profile_store.path_for(profile_id)
+   if not path:
+      return jsonify({"message": "Profile not found"}), 404
+   return send_file(path, as_attachment=True)
+
+@app.route('/api/admin/profiles/token', methods=['POST'])
+@jwt_required()
+@admin_required
+def admin_profile_token():
+   if not app.config['PROFILER_SECRET']:
+      return jsonify({"message": "Set PROFILER_SECRET to enable header-triggered profiling"}), 400
+   ttl = min((request.json or {}).get('ttl_seconds', 300), 3600)
+   expires_at = int(time.time() + ttl)
+   return jsonify({
+      "header": "X-Profile",
+      "token": sign_profile_token(app.config['PROFILER_SECRET'], expires_at),
+      "expires_at": expires_at
+   }), 201
+
 @app.route('/api/admin/users', methods=['GET'])
 @jwt_required()
 @admin_required
@@ -831,6 +2589,101 @@ def create_admin_command():
    result = create_admin_user(username, email, password)
    print(result)
 
+@app.cli.command("build-related")
+@click.option('--top-k', type=int, default=None, help='Neighbours kept per product')
+def build_related_command(top_k):
+   count = rebuild_related_products(top_k)
+   print(f"Stored related products for {count} products")
+
+@app.cli.command("rebuild-product-stats")
+def rebuild_product_stats_command():
+   rebuild_product_stats()
+   print(f"Rebuilt sales stats for {ProductStats.query.count()} products")
+
+@app.cli.command("build-columnar-catalog")
+def build_columnar_catalog_command():
+   if build_columnar_snapshot():
+      print(f"Columnar catalog snapshot ready for {Product.query.count()} products")
+   else:
+      print("Another process is building the snapshot")
+
+@app.cli.command("archive-orders")
+@click.option('--older-than-days', type=int, default=None, help='Archive finished orders older than this')
+@click.option('--chunk-size', type=int, default=500)
+def archive_orders_command(older_than_days, chunk_size):
+   days = older_than_days or app.config['ORDER_ARCHIVE_AFTER_DAYS']
+   archived = archive_orders(datetime.utcnow() - timedelta(days=days), chunk_size)
+   print(f"Archived {archived} orders older than {days} days")
+
+@app.cli.command("purge-idle-carts")
+@click.option('--days', type=int, default=None, help='Delete carts idle for longer than this')
+@click.option('--chunk-size', type=int, default=500)
+@click.option('--enqueue', is_flag=True, help='Hand the purge to the job worker instead')
+def purge_idle_carts_command(days, chunk_size, enqueue):
+   days = days or app.config['CART_IDLE_DAYS']
+   if enqueue:
+      enqueue_job('purge_idle_carts', days=days)
+      db.session.commit()
+      print("Queued idle cart purge")
+      return
+   purged, _ = purge_idle_carts(datetime.utcnow() - timedelta(days=days), chunk_size)
+   print(f"Deleted {purged} carts idle for more than {days} days")
+
+@app.cli.command("compact-catalog-changes")
+@click.option('--older-than-days', type=int, default=30, help='Keep tombstones at least this long')
+def compact_catalog_changes_command(older_than_days):
+   removed = compact_catalog_changes(datetime.utcnow() - timedelta(days=older_than_days))
+   print(f"Removed {removed} catalog tombstones")
+
+@app.cli.command("release-expired-reservations")
+def release_expired_reservations_command():
+   total = 0
+   while True:
+      released = release_expired_reservations()
+      total += released
+      if not released:
+         break
+   print(f"Released {total} expired stock reservations")
+
+@app.cli.command("run-worker")
+@click.option('--threads', type=int, default=4, help='Worker threads in this process')
+@click.option('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+@click.option('--burst', is_flag=True, help='Exit once the queue is empty')
+def run_worker_command(threads, poll_interval, burst):
+   stopping = threading.Event()
+   worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+   def work(n):
+      worker_id = f"{worker_prefix}:{n}"
+      while not stopping.is_set():
+         with app.app_context():
+            try:
+               processed = work_off_jobs(worker_id, limit=100)
+            except Exception:
+               logger.exception("Job worker error")
+               db.session.rollback()
+               processed = 0
+         if not processed:
+            if burst:
+               return
+            stopping.wait(poll_interval)
+
+   pool = [threading.Thread(target=work, args=(n,), daemon=True) for n in range(threads)]
+   for thread in pool:
+      thread.start()
+   print(f"Worker {worker_prefix} started with {threads} threads")
+   try:
+      while any(thread.is_alive() for thread in pool):
+         with app.app_context():
+            requeue_stale_jobs()
+            schedule_periodic_jobs()
+            db.session.commit()
+         stopping.wait(30 if not burst else poll_interval)
+   except KeyboardInterrupt:
+      stopping.set()
+   for thread in pool:
+      thread.join()
+
 # Alternatively, create a route to create an admin (Do not do this in production)
 @app.route('/api/create-admin', methods=['POST'])
 def create_admin_route():
@@ -864,13 +2717,20 @@ def home():
 def init_db():
    with app.app_context():
       db.create_all()
+      ensure_schema()
       seed_products()
+      ensure_product_stats()
 
 @app.route('/api/seed-products', methods=['POST'])
 def seed_products_route():
    try:
       current_app.logger.info("Starting product seeding process")
-      seed_products()
+      added_ids = seed_products()
+      ensure_product_stats()
+      if added_ids:
+         version = bump_catalog_version(added_ids)
+         db.session.commit()
+         publish_catalog_change(version)
       count = Product.query.count()
       return jsonify({"message": "Products seeded successfully", "count": count}), 200
    except Exception as e:
@@ -0,0 +1,125 @@
+"""Proxy-route throughput per gunicorn worker class against a slow upstream.
+
+   python benchmarks/worker_throughput.py --delay 0.2 --concurrency 50
+   python benchmarks/worker_throughput.py --worker-class sync --worker-class gthread
+
+A local stand-in for the FakeStore API answers every request after --delay
+seconds. For each worker class, gunicorn is started with gunicorn.conf.py
+and FAKESTORE_API_URL pointed at the stand-in, and --requests GETs of
+/api/carts/1 are sent from --concurrency client threads.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+   with socket.socket() as s:
+      s.bind(('127.0.0.1', 0))
+      return s.getsockname()[1]
+
+def start_upstream(delay):
+   class SlowUpstream(BaseHTTPRequestHandler):
+      def do_GET(self):
+         time.sleep(delay)
+         body = json.dumps({'id': 1, 'userId': 1, 'products': []}).encode()
+         self.send_response(200)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def log_message(self, *args):
+         pass
+
+   ThreadingHTTPServer.request_queue_size = 256
+   server = ThreadingHTTPServer(('127.0.0.1', free_port()), SlowUpstream)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server
+
+def wait_until_up(url, timeout=30):
+   deadline = time.monotonic() + timeout
+   while time.monotonic() < deadline:
+      try:
+         urllib.request.urlopen(url, timeout=1).read()
+         return
+      except OSError:
+         time.sleep(0.2)
+   raise RuntimeError(f"{url} did not come up")
+
+def timed_get(url):
+   started = time.perf_counter()
+   with urllib.request.urlopen(url, timeout=60) as response:
+      response.read()
+      ok = response.status == 200
+   return ok, time.perf_counter() - started
+
+def run(worker_class, args, env):
+   port = free_port()
+   env = dict(env, PORT=str(port), GUNICORN_WORKER_CLASS=worker_class,
+              WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads),
+              GUNICORN_WORKER_CONNECTIONS=str(args.concurrency * 2))
+   server = subprocess.Popen(
+      [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
+      cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+   )
+   try:
+      base = f"http://127.0.0.1:{port}"
+      wait_until_up(f"{base}/api/products/categories")
+      started = time.perf_counter()
+      with ThreadPoolExecutor(args.concurrency) as pool:
+         results = list(pool.map(timed_get, [f"{base}/api/carts/1"] * args.requests))
+      elapsed = time.perf_counter() - started
+   finally:
+      server.terminate()
+      server.wait()
+   latencies = sorted(seconds for _, seconds in results)
+   failed = sum(1 for ok, _ in results if not ok)
+   p95 = latencies[int(len(latencies) * 0.95) - 1]
+   print(f"{worker_class:8} {args.requests / elapsed:8.1f} req/s   "
+         f"p50 {statistics.median(latencies) * 1000:7.1f} ms   p95 {p95 * 1000:7.1f} ms   failed {failed}")
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+   parser.add_argument('--worker-class', action='append', choices=['sync', 'gthread', 'gevent'])
+   parser.add_argument('--workers', type=int, default=2)
+   parser.add_argument('--threads', type=int, default=8)
+   parser.add_argument('--delay', type=float, default=0.2, help='upstream response time in seconds')
+   parser.add_argument('--requests', type=int, default=200)
+   parser.add_argument('--concurrency', type=int, default=50)
+   args = parser.parse_args()
+
+   worker_classes = args.worker_class or ['sync', 'gthread', 'gevent']
+   if 'gevent' in worker_classes and importlib.util.find_spec('gevent') is None:
+      print("gevent is not installed; skipping the gevent worker")
+      worker_classes.remove('gevent')
+
+   upstream = start_upstream(args.delay)
+   env = dict(os.environ)
+   env['FAKESTORE_API_URL'] = f"http://127.0.0.1:{upstream.server_address[1]}"
+   env['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp()}/worker_bench.db"
+   env.setdefault('STRIPE_SECRET_KEY', 'sk_test_benchmark')
+
+   print(f"{args.workers} workers, upstream delay {args.delay * 1000:.0f} ms, "
+         f"{args.requests} requests from {args.concurrency} clients")
+   for worker_class in worker_classes:
+      run(worker_class, args, env)
+   upstream.shutdown()
+
+
+if __name__ == '__main__':
+   main()
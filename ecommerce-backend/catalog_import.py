@@ -0,0 +1,100 @@
+import csv
+import io
+import json
+
+PRODUCT_FIELDS = ('title', 'price', 'description', 'category', 'image', 'rating', 'rating_count')
+# Column sizes of the product table
+MAX_LENGTHS = {'sku': 64, 'title': 200, 'category': 100, 'image': 200}
+
+
+def iter_rows(stream, content_type):
+   """Yield (row_number, dict or None, error) from a CSV or NDJSON upload without buffering it."""
+   bad_lines = set()
+   lines = _decode_lines(stream, bad_lines)
+   if 'csv' in content_type:
+      reader = csv.DictReader(lines)
+      if reader.fieldnames is None:
+         return
+      if bad_lines:
+         yield 1, None, 'Header is not valid UTF-8'
+         return
+      read_through = reader.line_num
+      for number, row in enumerate(reader, start=1):
+         if any(read_through < line <= reader.line_num for line in bad_lines):
+            yield number, None, 'Row is not valid UTF-8'
+         elif None in row:
+            yield number, None, 'Row has more columns than the header'
+         else:
+            yield number, row, None
+         read_through = reader.line_num
+      return
+   for number, line in enumerate(lines, start=1):
+      if number in bad_lines:
+         yield number, None, 'Line is not valid UTF-8'
+         continue
+      line = line.strip()
+      if not line:
+         continue
+      try:
+         row = json.loads(line)
+      except ValueError as e:
+         yield number, None, f"Invalid JSON: {e}"
+         continue
+      if not isinstance(row, dict):
+         yield number, None, 'Each line must be a JSON object'
+      else:
+         yield number, row, None
+
+def _decode_lines(stream, bad_lines):
+   # Decoded one line at a time so a bad byte only spoils its own row;
+   # undecodable lines are recorded in bad_lines and passed on mangled
+   for number, raw in enumerate(stream, start=1):
+      try:
+         yield raw.decode('utf-8-sig' if number == 1 else 'utf-8')
+      except UnicodeDecodeError:
+         bad_lines.add(number)
+         yield raw.decode('utf-8', errors='replace')
+
+def _blank(value):
+   return value is None or (isinstance(value, str) and value.strip() == '')
+
+def _number(values, errors, row, field, cast, minimum=None, maximum=None):
+   if _blank(row.get(field)):
+      return
+   try:
+      value = cast(row[field])
+   except (TypeError, ValueError):
+      errors.append(f"{field} must be a number")
+      return
+   if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+      errors.append(f"{field} must be between {minimum} and {maximum}" if maximum is not None
+                    else f"{field} must be at least {minimum}")
+      return
+   values[field] = value
+
+def validate_row(row):
+   """Return (values, errors) for one upload row.
+
+   Blank cells and missing keys leave the stored value untouched, so a file
+   with only id/sku and price columns is a price update.
+   """
+   values = {}
+   errors = []
+   _number(values, errors, row, 'id', lambda v: int(str(v)), minimum=1)
+   if not _blank(row.get('sku')):
+      values['sku'] = str(row['sku']).strip()
+   if 'id' not in values and 'sku' not in values and not errors:
+      errors.append('id or sku is required')
+
+   for field in ('title', 'description', 'category', 'image'):
+      if not _blank(row.get(field)):
+         values[field] = str(row[field]).strip()
+   for field, length in MAX_LENGTHS.items():
+      if len(values.get(field, '')) > length:
+         errors.append(f'{field} must be at most {length} characters')
+   _number(values, errors, row, 'price', float, minimum=0)
+   # One decimal like the seed data, which keeps the facet index's rating groups few
+   _number(values, errors, row, 'rating', lambda v: round(float(v), 1), minimum=0, maximum=5)
+   _number(values, errors, row, 'rating_count', lambda v: int(str(v)), minimum=0)
+   _number(values, errors, row, 'stock', lambda v: int(str(v)), minimum=0)
+   return values, errors
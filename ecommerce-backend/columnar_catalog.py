@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+TEXT_FIELDS = ('title', 'description', 'image')
+# Row orders precomputed per snapshot; every one breaks ties on id like the SQL sorts
+SORT_ORDERS = ('id', 'price_asc', 'price_desc', 'rating')
+# Rows checked per step when scanning a sort order for a filtered page
+SCAN_CHUNK = 4096
+# Snapshot build locks older than this are assumed to belong to a dead process
+STALE_LOCK_SECONDS = 600
+
+
+class ColumnarCatalog:
+   """Read-only, column-per-array copy of the product table.
+
+   Numeric columns are NumPy arrays; text columns are one UTF-8 byte buffer
+   per field plus an offsets array, so a snapshot is a directory of .npy
+   files that ``load`` memory-maps instead of reading into each process.
+   Each supported sort is stored as a row permutation, so a page is read by
+   filtering that permutation front to back until it has enough rows.
+   """
+
+   def __init__(self, columns, categories):
+      self.columns = columns
+      self.categories = categories
+      self._category_codes = {name: code for code, name in enumerate(categories)}
+
+   def __len__(self):
+      return len(self.columns['id'])
+
+   @classmethod
+   def build(cls, rows):
+      """Build from rows of (id, title, price, description, category, image, rating, rating_count)."""
+      ids, prices, ratings, counts, category_names = [], [], [], [], []
+      texts = {field: [] for field in TEXT_FIELDS}
+      for product_id, title, price, description, category, image, rating, rating_count in rows:
+         ids.append(product_id)
+         prices.append(price)
+         ratings.append(np.nan if rating is None else rating)
+         counts.append(-1 if rating_count is None else rating_count)
+         category_names.append(category)
+         for field, value in zip(TEXT_FIELDS, (title, description, image)):
+            texts[field].append(value)
+
+      categories = sorted({c for c in category_names if c is not None})
+      codes = {name: code for code, name in enumerate(categories)}
+      columns = {
+         'id': np.array(ids, dtype=np.int64),
+         'price': np.array(prices, dtype=np.float64),
+         'rating': np.array(ratings, dtype=np.float64),
+         'rating_count': np.array(counts, dtype=np.int64),
+         'category': np.array([codes.get(c, -1) for c in category_names], dtype=np.int32),
+      }
+      for field, values in texts.items():
+         encoded = [(v or '').encode() for v in values]
+         columns[f'{field}_offsets'] = np.concatenate(([0], np.cumsum([len(e) for e in encoded], dtype=np.int64)))
+         columns[f'{field}_bytes'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+         columns[f'{field}_null'] = np.array([v is None for v in values], dtype=bool)
+
+      ids = columns['id']
+      # Unrated products last, as with DESC on a NULL column
+      rating = np.nan_to_num(-columns['rating'], nan=np.inf)
+      columns['order_id'] = np.argsort(ids, kind='stable')
+      columns['order_price_asc'] = np.lexsort((ids, columns['price']))
+      columns['order_price_desc'] = np.lexsort((ids, -columns['price']))
+      columns['order_rating'] = np.lexsort((ids, -columns['rating_count'], rating))
+      return cls(columns, categories)
+
+   def save(self, path):
+      """Write the snapshot to ``path`` atomically (it appears complete or not at all)."""
+      staging = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+      os.makedirs(staging)
+      for name, array in self.columns.items():
+         np.save(os.path.join(staging, f'{name}.npy'), array)
+      with open(os.path.join(staging, 'categories.json'), 'w', encoding='utf-8') as f:
+         json.dump(self.categories, f)
+      try:
+         os.rename(staging, path)
+      except OSError:
+         # Someone else published the same snapshot first
+         shutil.rmtree(staging, ignore_errors=True)
+
+   @classmethod
+   def load(cls, path):
+      columns = {}
+      for filename in os.listdir(path):
+         if filename.endswith('.npy'):
+            try:
+               array = np.load(os.path.join(path, filename), mmap_mode='r')
+            except ValueError:
+               # Empty arrays cannot be mapped
+               array = np.load(os.path.join(path, filename))
+            columns[filename[:-len('.npy')]] = array
+      with open(os.path.join(path, 'categories.json'), encoding='utf-8') as f:
+         categories = json.load(f)
+      return cls(columns, categories)
+
+   def query(self, categories=None, min_price=None, max_price=None, min_rating=None,
+             sort=None, offset=0, limit=None):
+      """Row positions for one page of matching products."""
+      order = self._order(sort)
+      offset = offset or 0
+      end = offset + limit if limit else None
+      match = self._matcher(categories, min_price, max_price, min_rating)
+      if match is None:
+         return order[offset:end]
+      if end is None:
+         return order[match(order)][offset:]
+      found = []
+      count = 0
+      start = 0
+      chunk = max(SCAN_CHUNK, end * 4)
+      while start < len(order) and count < end:
+         part = order[start:start + chunk]
+         part = part[match(part)]
+         found.append(part)
+         count += len(part)
+         start += chunk
+         # Selective filters match little per chunk, so read more each time
+         chunk *= 2
+      return np.concatenate(found)[offset:end] if found else order[:0]
+
+   def count(self, categories=None, min_price=None, max_price=None, min_rating=None):
+      match = self._matcher(categories, min_price, max_price, min_rating)
+      return len(self) if match is None else int(np.count_nonzero(match(slice(None))))
+
+   def rows(self, positions):
+      c = self.columns
+      products = []
+      for i in positions:
+         rating = c['rating'][i]
+         rating_count = c['rating_count'][i]
+         code = c['category'][i]
+         products.append({
+            'id': int(c['id'][i]),
+            'title': self._text('title', i),
+            'price': float(c['price'][i]),
+            'description': self._text('description', i),
+            'category': self.categories[code] if code >= 0 else None,
+            'image': self._text('image', i),
+            'rating': {
+               'rate': None if np.isnan(rating) else float(rating),
+               'count': None if rating_count < 0 else int(rating_count)
+            }
+         })
+      return products
+
+   def _text(self, field, i):
+      if self.columns[f'{field}_null'][i]:
+         return None
+      offsets = self.columns[f'{field}_offsets']
+      return bytes(self.columns[f'{field}_bytes'][offsets[i]:offsets[i + 1]]).decode()
+
+   def _order(self, sort):
+      if sort == 'desc':
+         return self.columns['order_id'][::-1]
+      if sort in SORT_ORDERS:
+         return self.columns[f'order_{sort}']
+      return self.columns['order_id']
+
+   def _matcher(self, categories, min_price, max_price, min_rating):
+      """A function from row positions to a boolean mask, or None to match every row."""
+      c = self.columns
+      tests = []
+      if categories:
+         wanted = [self._category_codes[name] for name in categories if name in self._category_codes]
+         tests.append(lambda rows: np.isin(c['category'][rows], wanted))
+      if min_price is not None:
+         tests.append(lambda rows: c['price'][rows] >= min_price)
+      if max_price is not None:
+         tests.append(lambda rows: c['price'][rows] <= max_price)
+      if min_rating is not None:
+         tests.append(lambda rows: c['rating'][rows] >= min_rating)
+      if not tests:
+         return None
+
+      def match(rows):
+         mask = tests[0](rows)
+         for test in tests[1:]:
+            mask &= test(rows)
+         return mask
+      return match
+
+def ensure_snapshot(path, load_rows):
+   """Write the snapshot at ``path`` unless it exists; False if another process is writing it."""
+   if os.path.isdir(path):
+      return True
+   os.makedirs(os.path.dirname(path), exist_ok=True)
+   lock = f"{path}.lock"
+   try:
+      fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+   except FileExistsError:
+      try:
+         if time.time() - os.path.getmtime(lock) > STALE_LOCK_SECONDS:
+            os.remove(lock)
+      except FileNotFoundError:
+         pass
+      return False
+   try:
+      os.close(fd)
+      if not os.path.isdir(path):
+         ColumnarCatalog.build(load_rows()).save(path)
+   finally:
+      os.remove(lock)
+   return True
+
+def prune_snapshots(directory, keep=2):
+   """Remove all but the ``keep`` newest "v<version>" snapshots.
+
+   Workers still mapping a removed snapshot keep reading it until they move on.
+   """
+   versions = sorted((int(name[1:]) for name in os.listdir(directory)
+                      if name.startswith('v') and name[1:].isdigit()), reverse=True)
+   for version in versions[keep:]:
+      shutil.rmtree(os.path.join(directory, f"v{version}"), ignore_errors=True)
@@ -0,0 +1,130 @@
+import bisect
+import math
+import threading
+
+PRICE_EDGES = (0, 25, 50, 100, 250, 500)
+RATING_BANDS = (4, 3, 2, 1)
+
+
+def _count_between(prices, low, high):
+   """Prices with low <= price < high."""
+   return bisect.bisect_left(prices, high) - bisect.bisect_left(prices, low)
+
+
+class FacetIndex:
+   """Facet counts over category, price and rating, kept in memory.
+
+   Prices are stored sorted per (category, rating) group, so counting the
+   products matching any category set, price range and minimum rating takes
+   two bisects per group rather than a pass over the catalog. Groups use the
+   exact rating, so filters agree with SQL; the catalog keeps ratings to one
+   decimal, which keeps the groups few. Unrated products never meet a
+   minimum rating.
+   """
+
+   def __init__(self, price_edges=PRICE_EDGES, rating_bands=RATING_BANDS):
+      self.price_edges = price_edges
+      self.rating_bands = rating_bands
+      self.ready = False
+      self._groups = {}
+      self._docs = {}
+      self._lock = threading.RLock()
+
+   def build(self, rows):
+      """Replace the contents with rows of (id, category, price, rating)."""
+      groups = {}
+      docs = {}
+      for product_id, category, price, rating in rows:
+         key = (category, rating)
+         docs[product_id] = (key, price)
+         groups.setdefault(key, []).append(price)
+      for prices in groups.values():
+         prices.sort()
+      with self._lock:
+         self._groups = groups
+         self._docs = docs
+         self.ready = True
+
+   def build_once(self, load_rows):
+      if self.ready:
+         return
+      with self._lock:
+         if not self.ready:
+            self.build(load_rows())
+
+   def upsert(self, product_id, category, price, rating):
+      with self._lock:
+         self._remove(product_id)
+         key = (category, rating)
+         self._docs[product_id] = (key, price)
+         bisect.insort(self._groups.setdefault(key, []), price)
+
+   def remove(self, product_id):
+      with self._lock:
+         self._remove(product_id)
+
+   def count(self, categories=None, min_price=None, max_price=None, min_rating=None):
+      low, high = _price_bounds(min_price, max_price)
+      with self._lock:
+         return sum(_count_between(prices, low, high)
+                    for prices in self._matching(categories, min_rating))
+
+   def facets(self, categories=None, min_price=None, max_price=None, min_rating=None):
+      """Counts for each facet value, applying every filter except the facet's own."""
+      low, high = _price_bounds(min_price, max_price)
+      by_category = {}
+      price_counts = [0] * len(self.price_edges)
+      rating_counts = [0] * len(self.rating_bands)
+      edges = self.price_edges[1:] + (math.inf,)
+      with self._lock:
+         for (category, rating), prices in self._groups.items():
+            in_categories = not categories or category in categories
+            in_rating = _meets(rating, min_rating)
+            if in_rating and category is not None:
+               count = _count_between(prices, low, high)
+               if count:
+                  by_category[category] = by_category.get(category, 0) + count
+            if in_categories and in_rating:
+               for i, (start, end) in enumerate(zip(self.price_edges, edges)):
+                  price_counts[i] += _count_between(prices, start, end)
+            if in_categories:
+               count = None
+               for i, band in enumerate(self.rating_bands):
+                  if _meets(rating, band):
+                     if count is None:
+                        count = _count_between(prices, low, high)
+                     rating_counts[i] += count
+      return {
+         'categories': [{'value': c, 'count': n} for c, n in sorted(by_category.items(), key=lambda item: (-item[1], item[0]))],
+         'price': [{'min': start, 'max': None if end == math.inf else end, 'count': n}
+                   for start, end, n in zip(self.price_edges, edges, price_counts)],
+         'rating': [{'min': band, 'count': n} for band, n in zip(self.rating_bands, rating_counts)]
+      }
+
+   def _matching(self, categories, min_rating):
+      for (category, rating), prices in self._groups.items():
+         if categories and category not in categories:
+            continue
+         if not _meets(rating, min_rating):
+            continue
+         yield prices
+
+   def _remove(self, product_id):
+      doc = self._docs.pop(product_id, None)
+      if doc is None:
+         return
+      key, price = doc
+      prices = self._groups[key]
+      del prices[bisect.bisect_left(prices, price)]
+      if not prices:
+         del self._groups[key]
+
+
+def _meets(rating, min_rating):
+   return min_rating is None or (rating is not None and rating >= min_rating)
+
+def _price_bounds(min_price, max_price):
+   # max_price is inclusive, like the SQL filter
+   low = -math.inf if min_price is None else min_price
+   high = math.inf if max_price is None else math.nextafter(max_price, math.inf)
+   return low, high
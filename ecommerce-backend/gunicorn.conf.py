@@ -0,0 +1,40 @@
+"""Gunicorn settings, all overridable from the environment.
+
+The default gthread workers serve GUNICORN_THREADS requests each, so a
+request waiting on FakeStore or Stripe only holds one thread. Set
+GUNICORN_WORKER_CLASS=gevent for green threads instead (GUNICORN_WORKER_CONNECTIONS
+per worker); psycopg2 then needs psycogreen to yield while waiting on
+Postgres. GUNICORN_WORKER_CLASS=sync restores one request per process.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# Gunicorn silently swaps sync workers for gthread when threads > 1
+threads = int(os.getenv('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+
+# app.py sizes the database pool from these
+if worker_class == 'gthread':
+   os.environ.setdefault('DB_POOL_SIZE', str(threads))
+elif worker_class == 'gevent':
+   os.environ.setdefault('DB_POOL_SIZE', str(min(worker_connections, 20)))
+
+
+def post_fork(server, worker):
+   if worker_class != 'gevent':
+      return
+   try:
+      from psycogreen.gevent import patch_psycopg
+   except ImportError:
+      server.log.warning("psycogreen is not installed; Postgres queries will block the gevent worker")
+      return
+   patch_psycopg()
@@ -0,0 +1,166 @@
+import cProfile
+import hashlib
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+
+def sign_profile_token(secret, expires_at):
+   """Return an "<expiry>.<signature>" value for the X-Profile request header."""
+   expires_at = int(expires_at)
+   signature = hmac.new(secret.encode(), str(expires_at).encode(), hashlib.sha256).hexdigest()
+   return f"{expires_at}.{signature}"
+
+def verify_profile_token(secret, token):
+   if not secret or not token or '.' not in token:
+      return False
+   expires_at, _, signature = token.partition('.')
+   if not expires_at.isdigit() or int(expires_at) < time.time():
+      return False
+   expected = sign_profile_token(secret, int(expires_at)).partition('.')[2]
+   return hmac.compare_digest(expected, signature)
+
+
+class StackSampler:
+   """Samples one thread's Python stack on an interval into collapsed-stack counts.
+
+   The output is the "frame;frame;frame count" format read by flamegraph.pl
+   and speedscope.
+   """
+
+   def __init__(self, thread_id, interval=0.001):
+      self.thread_id = thread_id
+      self.interval = interval
+      self.stacks = {}
+      self.samples = 0
+      self._stop = threading.Event()
+      self._thread = threading.Thread(target=self._run, daemon=True)
+
+   def start(self):
+      self._thread.start()
+
+   def stop(self):
+      self._stop.set()
+      self._thread.join()
+
+   def _run(self):
+      while not self._stop.wait(self.interval):
+         frame = sys._current_frames().get(self.thread_id)
+         if frame is None:
+            continue
+         stack = []
+         while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+         key = ';'.join(reversed(stack))
+         self.stacks[key] = self.stacks.get(key, 0) + 1
+         self.samples += 1
+
+   def collapsed(self):
+      return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+class RequestProfile:
+   """Timings gathered for one profiled request."""
+
+   def __init__(self, mode='sampler', interval=0.001):
+      self.mode = mode
+      self.sql_seconds = 0.0
+      self.sql_count = 0
+      self.serialize_seconds = 0.0
+      self.started = time.perf_counter()
+      self.duration = None
+      if mode == 'cprofile':
+         self.profiler = cProfile.Profile()
+         self.profiler.enable()
+      else:
+         self.profiler = StackSampler(threading.get_ident(), interval)
+         self.profiler.start()
+
+   def finish(self):
+      if self.duration is not None:
+         return
+      if self.mode == 'cprofile':
+         self.profiler.disable()
+      else:
+         self.profiler.stop()
+      self.duration = time.perf_counter() - self.started
+
+
+class ProfileStore:
+   """Keeps the most recent profiles on disk as <id>.json metadata plus the profile data."""
+
+   _ID_RE = re.compile(r'^[0-9]{20}-[0-9a-f]{8}$')
+
+   def __init__(self, directory, keep=200):
+      self.directory = directory
+      self.keep = keep
+      self._lock = threading.Lock()
+
+   def save(self, profile, meta):
+      os.makedirs(self.directory, exist_ok=True)
+      profile_id = f"{datetime.utcnow():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+      if profile.mode == 'cprofile':
+         filename = f"{profile_id}.prof"
+         profile.profiler.dump_stats(os.path.join(self.directory, filename))
+         samples = None
+      else:
+         filename = f"{profile_id}.collapsed"
+         with open(os.path.join(self.directory, filename), 'w') as f:
+            f.write(profile.profiler.collapsed())
+         samples = profile.profiler.samples
+      meta = dict(meta, **{
+         'id': profile_id,
+         'mode': profile.mode,
+         'file': filename,
+         'created_at': datetime.utcnow().isoformat(),
+         'duration_ms': round(profile.duration * 1000, 3),
+         'sql_ms': round(profile.sql_seconds * 1000, 3),
+         'sql_queries': profile.sql_count,
+         'serialize_ms': round(profile.serialize_seconds * 1000, 3),
+         'samples': samples
+      })
+      with open(os.path.join(self.directory, f"{profile_id}.json"), 'w') as f:
+         json.dump(meta, f)
+      self._prune()
+      return meta
+
+   def list(self, limit=50):
+      if not os.path.isdir(self.directory):
+         return []
+      names = sorted((n for n in os.listdir(self.directory) if n.endswith('.json')), reverse=True)
+      profiles = []
+      for name in names[:limit]:
+         try:
+            with open(os.path.join(self.directory, name)) as f:
+               profiles.append(json.load(f))
+         except (OSError, ValueError):
+            continue
+      return profiles
+
+   def path_for(self, profile_id):
+      if not self._ID_RE.match(profile_id):
+         return None
+      for extension in ('.collapsed', '.prof'):
+         path = os.path.join(self.directory, profile_id + extension)
+         if os.path.exists(path):
+            return path
+      return None
+
+   def _prune(self):
+      with self._lock:
+         names = sorted(n for n in os.listdir(self.directory) if n.endswith('.json'))
+         for name in names[:max(0, len(names) - self.keep)]:
+            profile_id = name[:-len('.json')]
+            for extension in ('.json', '.collapsed', '.prof'):
+               try:
+                  os.remove(os.path.join(self.directory, profile_id + extension))
+               except FileNotFoundError:
+                  pass
@@ -0,0 +1,39 @@
+import numpy as np
+from scipy import sparse
+
+
+def top_k_cooccurrence(order_ids, product_ids, k=10):
+   """Return {product_id: [(related_id, orders_in_common), ...]} for the k strongest pairs.
+
+   ``order_ids`` and ``product_ids`` are parallel sequences, one entry per
+   order line. Co-occurrence is counted once per order however many units or
+   lines a product has in it.
+   """
+   if len(order_ids) == 0:
+      return {}
+   orders, order_idx = np.unique(np.asarray(order_ids), return_inverse=True)
+   products, product_idx = np.unique(np.asarray(product_ids), return_inverse=True)
+
+   baskets = sparse.csr_matrix(
+      (np.ones(len(order_idx), dtype=np.int32), (order_idx, product_idx)),
+      shape=(len(orders), len(products))
+   )
+   baskets.data[:] = 1
+   counts = (baskets.T @ baskets).tocsr()
+   counts.setdiag(0)
+   counts.eliminate_zeros()
+
+   related = {}
+   for row in np.flatnonzero(np.diff(counts.indptr)):
+      start, end = counts.indptr[row], counts.indptr[row + 1]
+      cols = counts.indices[start:end]
+      scores = counts.data[start:end]
+      if len(scores) > k:
+         keep = np.argpartition(-scores, k - 1)[:k]
+         cols, scores = cols[keep], scores[keep]
+      # Highest count first, lowest product id breaks ties
+      order = np.lexsort((products[cols], -scores))
+      related[int(products[row])] = [
+         (int(products[cols[i]]), int(scores[i])) for i in order
+      ]
+   return related
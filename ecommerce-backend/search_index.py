@@ -0,0 +1,202 @@
+import bisect
+import heapq
+from functools import lru_cache
+import re
+import threading
+import unicodedata
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# Sorts after every character a normalized token or id can contain
+_PREFIX_END = "\uffff"
+
+
+def normalize(text):
+   text = text or ''
+   if text.isascii():
+      return text.lower()
+   text = unicodedata.normalize('NFKD', text)
+   return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+def tokenize(text):
+   return _TOKEN_RE.findall(normalize(text))
+
+@lru_cache(maxsize=4096)
+def _category_tokens(category):
+   return frozenset(tokenize(category))
+
+
+class PrefixIndex:
+   """In-memory typeahead index over product titles and categories.
+
+   Every (token, product) pair is stored as one "token\\0id" string in a
+   sorted list, so a prefix lookup is two bisects. Prefixes matching more
+   than ``scan_limit`` pairs ("a", "ba") get their best-ranked products
+   cached; a cache entry is dropped when a product carrying a token under
+   that prefix changes. A multi-term query the cache cannot answer checks at
+   most ``max_scan`` pairs of its narrowest term, shortest tokens first.
+   """
+
+   def __init__(self, scan_limit=256, cache_depth=64, max_scan=5000):
+      self.scan_limit = scan_limit
+      self.cache_depth = cache_depth
+      self.max_scan = max_scan
+      self.ready = False
+      self._entries = []
+      self._docs = {}
+      self._category_entries = []
+      self._category_counts = {}
+      self._top = {}
+      self._lock = threading.RLock()
+
+   def build(self, rows):
+      """Replace the index contents with rows of (id, title, category, rating, rating_count)."""
+      entries = []
+      docs = {}
+      counts = {}
+      for product_id, title, category, rating, rating_count in rows:
+         doc = self._make_doc(title, category, rating, rating_count)
+         docs[product_id] = doc
+         suffix = f"\0{product_id}"
+         entries.extend(token + suffix for token in doc['tokens'])
+         if category:
+            counts[category] = counts.get(category, 0) + 1
+      entries.sort()
+      top = self._warm_top(entries, docs)
+      category_entries = sorted(f"{token}\0{c}" for c in counts for token in _category_tokens(c))
+      with self._lock:
+         self._entries = entries
+         self._docs = docs
+         self._category_entries = category_entries
+         self._category_counts = counts
+         self._top = top
+         self.ready = True
+
+   def upsert(self, product_id, title, category, rating=None, rating_count=None):
+      with self._lock:
+         self._remove(product_id)
+         doc = self._make_doc(title, category, rating, rating_count)
+         self._docs[product_id] = doc
+         for token in doc['tokens']:
+            bisect.insort(self._entries, f"{token}\0{product_id}")
+         if category:
+            self._count_category(category, 1)
+         self._invalidate(doc['tokens'])
+
+   def remove(self, product_id):
+      with self._lock:
+         self._remove(product_id)
+
+   def suggest(self, query, limit=8):
+      terms = tokenize(query)
+      if not terms:
+         return [], []
+      if len(terms) == 1:
+         matches = None
+      else:
+         matches = lambda tokens: all(any(t.startswith(term) for t in tokens) for term in terms)
+      with self._lock:
+         # Look up the term with the narrowest range; the rest are checked per candidate
+         anchor = min(terms, key=lambda term: _range_size(self._entries, term))
+         product_ids = self._ranked(anchor, limit, matches)
+         products = [(pid, self._docs[pid]) for pid in product_ids]
+         lo, hi = _prefix_range(self._category_entries, anchor)
+         categories = {e.split('\0', 1)[1] for e in self._category_entries[lo:hi]}
+         if matches:
+            categories = [c for c in categories if matches(_category_tokens(c))]
+         categories = sorted(categories, key=lambda c: (-self._category_counts[c], c))[:limit]
+      return products, categories
+
+   def _make_doc(self, title, category, rating, rating_count):
+      return {
+         'title': title,
+         'category': category,
+         'rating': rating,
+         'rating_count': rating_count,
+         'tokens': frozenset(tokenize(title)) | _category_tokens(category or ''),
+         'rank': (rating or 0, rating_count or 0)
+      }
+
+   def _rank_key(self, product_id):
+      return self._docs[product_id]['rank'] + (-product_id,)
+
+   def _warm_top(self, entries, docs):
+      # Precompute the wide one and two character prefixes in a single pass
+      # over products in rank order, so first keystrokes never scan the index
+      alphabet = sorted({e[0] for e in entries})
+      prefixes = alphabet + [a + b for a in alphabet for b in alphabet]
+      wide = {}
+      for prefix in prefixes:
+         lo, hi = _prefix_range(entries, prefix)
+         if hi - lo > self.scan_limit:
+            wide[prefix] = []
+      pending = len(wide)
+      rank = lambda pid: docs[pid]['rank'] + (-pid,)
+      for pid in sorted(docs, key=rank, reverse=True):
+         if not pending:
+            break
+         for token in docs[pid]['tokens']:
+            for prefix in (token[:1], token[:2]):
+               top = wide.get(prefix)
+               if top is not None and len(top) < self.cache_depth and (not top or top[-1] != pid):
+                  top.append(pid)
+                  if len(top) == self.cache_depth:
+                     pending -= 1
+      return wide
+
+   def _ids(self, lo, hi):
+      return {int(e.rsplit('\0', 1)[1]) for e in self._entries[lo:hi]}
+
+   def _ranked(self, prefix, limit, matches):
+      lo, hi = _prefix_range(self._entries, prefix)
+      if hi - lo > self.scan_limit:
+         top = self._top.get(prefix)
+         if top is None:
+            top = heapq.nlargest(self.cache_depth, self._ids(lo, hi), key=self._rank_key)
+            self._top[prefix] = top
+         if matches:
+            results = [pid for pid in top if matches(self._docs[pid]['tokens'])][:limit]
+         else:
+            results = top[:limit]
+         if len(results) == limit or len(top) < self.cache_depth:
+            return results
+      if matches:
+         ids = [pid for pid in self._ids(lo, min(hi, lo + self.max_scan)) if matches(self._docs[pid]['tokens'])]
+      else:
+         ids = self._ids(lo, hi)
+      return heapq.nlargest(limit, ids, key=self._rank_key)
+
+   def _remove(self, product_id):
+      doc = self._docs.pop(product_id, None)
+      if doc is None:
+         return
+      for token in doc['tokens']:
+         key = f"{token}\0{product_id}"
+         i = bisect.bisect_left(self._entries, key)
+         if i < len(self._entries) and self._entries[i] == key:
+            del self._entries[i]
+      if doc['category']:
+         self._count_category(doc['category'], -1)
+      self._invalidate(doc['tokens'])
+
+   def _count_category(self, category, delta):
+      count = self._category_counts.get(category, 0) + delta
+      if count > 0 and category not in self._category_counts:
+         for token in _category_tokens(category):
+            bisect.insort(self._category_entries, f"{token}\0{category}")
+      elif count <= 0:
+         self._category_entries = [e for e in self._category_entries if e.split('\0', 1)[1] != category]
+         self._category_counts.pop(category, None)
+         return
+      self._category_counts[category] = count
+
+   def _invalidate(self, tokens):
+      for prefix in [p for p in self._top if any(t.startswith(p) for t in tokens)]:
+         del self._top[prefix]
+
+
+def _prefix_range(entries, prefix):
+   return bisect.bisect_left(entries, prefix), bisect.bisect_left(entries, prefix + _PREFIX_END)
+
+def _range_size(entries, prefix):
+   lo, hi = _prefix_range(entries, prefix)
+   return hi - lo
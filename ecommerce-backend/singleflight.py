@@ -0,0 +1,70 @@
+import threading
+
+
+class SingleFlightTimeout(TimeoutError):
+   pass
+
+
+class _Call:
+   def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+      self.waiters = 0
+
+
+class SingleFlight:
+   """Runs at most one call per key at a time within the process.
+
+   Callers that arrive while a call for their key is in flight wait for it
+   and get its result, or its exception re-raised, instead of repeating the
+   work. Nothing is cached once the call finishes.
+   """
+
+   def __init__(self, timeout=10.0):
+      self.timeout = timeout
+      self._calls = {}
+      self._lock = threading.Lock()
+      self._stats = {'requests': 0, 'executions': 0, 'shared': 0, 'errors': 0, 'timeouts': 0}
+
+   def do(self, key, fn, timeout=None):
+      with self._lock:
+         self._stats['requests'] += 1
+         call = self._calls.get(key)
+         if call is None:
+            call = self._calls[key] = _Call()
+            leader = True
+            self._stats['executions'] += 1
+         else:
+            leader = False
+            call.waiters += 1
+            self._stats['shared'] += 1
+
+      if leader:
+         try:
+            call.result = fn()
+         except BaseException as e:
+            call.error = e
+            with self._lock:
+               self._stats['errors'] += 1
+            raise
+         finally:
+            with self._lock:
+               del self._calls[key]
+            call.done.set()
+         return call.result
+
+      if not call.done.wait(self.timeout if timeout is None else timeout):
+         with self._lock:
+            self._stats['timeouts'] += 1
+         raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key!r}")
+      if call.error is not None:
+         raise call.error
+      return call.result
+
+   def metrics(self):
+      with self._lock:
+         stats = dict(self._stats, in_flight=len(self._calls))
+      # Share of requests answered by another request's call
+      stats['coalescing_ratio'] = round(stats['shared'] / stats['requests'], 4) if stats['requests'] else 0.0
+      return stats
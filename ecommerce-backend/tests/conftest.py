@@ -0,0 +1,42 @@
+import os
+
+# Point the app at a throwaway database before it is first imported
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_offline')
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from app import app as flask_app, db, User
+
+
+@pytest.fixture
+def app():
+   flask_app.config['TESTING'] = True
+   yield flask_app
+
+@pytest.fixture
+def client(app):
+   return app.test_client()
+
+@pytest.fixture
+def admin_headers(app):
+   with app.app_context():
+      admin = User.query.filter_by(username='test-admin').first()
+      if not admin:
+         admin = User(username='test-admin', email='admin@example.com', password='x', role='admin')
+         db.session.add(admin)
+         db.session.commit()
+      token = create_access_token(identity=admin.id)
+   return {'Authorization': f'Bearer {token}'}
+
+@pytest.fixture
+def user_headers(app):
+   with app.app_context():
+      user = User.query.filter_by(username='test-user').first()
+      if not user:
+         user = User(username='test-user', email='user@example.com', password='x')
+         db.session.add(user)
+         db.session.commit()
+      token = create_access_token(identity=user.id)
+   return {'Authorization': f'Bearer {token}'}
@@ -1,2 +1,543 @@
+from datetime import datetime
+
+import pytest
+
 def test_sample():
-   assert True
\ No newline at end of file
+   assert True
+
+def test_suggest_products(client):
+   response = client.get('/api/products/suggest?q=backp')
+   assert response.status_code == 200
+   titles = [p['title'] for p in response.json['products']]
+   assert titles and all('Backpack' in title for title in titles)
+
+def test_suggest_follows_admin_changes(client, admin_headers):
+   client.get('/api/products/suggest?q=x')
+   response = client.post('/api/admin/products', headers=admin_headers,
+                          json={'title': 'Zyzzyva Lamp', 'price': 10, 'category': 'home'})
+   product_id = response.json['id']
+   assert client.get('/api/products/suggest?q=zyzz').json['products'][0]['id'] == product_id
+   client.delete(f'/api/admin/products/{product_id}', headers=admin_headers)
+   assert client.get('/api/products/suggest?q=zyzz').json['products'] == []
+
+def test_suggest_index_builds_off_the_request_path(client, app, monkeypatch):
+   import time
+   import app as app_module
+   from search_index import PrefixIndex
+   real_rows = app_module.load_suggest_rows
+
+   def slow_rows():
+      time.sleep(0.3)
+      return real_rows()
+
+   monkeypatch.setattr(app_module, 'suggest_index', PrefixIndex())
+   monkeypatch.setattr(app_module, 'load_suggest_rows', slow_rows)
+   monkeypatch.setitem(app.config, 'SUGGEST_BUILD_WAIT_SECONDS', 0)
+   assert client.get('/api/products/suggest?q=backp').json['products'] == []
+   while app_module.suggest_state['building'] is not None:
+      time.sleep(0.01)
+   assert client.get('/api/products/suggest?q=backp').json['products']
+
+def test_suggest_follows_changes_from_other_workers(client, app, monkeypatch):
+   import app as app_module
+   from app import db, Product, bump_catalog_version, ensure_product_stats
+   client.get('/api/products/suggest?q=x')
+
+   def no_rebuild(rows):
+      raise AssertionError('index was rebuilt')
+
+   monkeypatch.setattr(app_module.suggest_index, 'build', no_rebuild)
+   with app.app_context():
+      # As another worker would: commit and log the change without publishing it here
+      product = Product(title='Quokka Mug', price=4)
+      db.session.add(product)
+      db.session.flush()
+      product_id = product.id
+      bump_catalog_version([product_id])
+      db.session.commit()
+      ensure_product_stats()
+   monkeypatch.setitem(app_module.catalog_state, 'checked_at', 0.0)
+   assert [p['id'] for p in client.get('/api/products/suggest?q=quokka').json['products']] == [product_id]
+
+def place_order(client, headers, product_ids):
+   items = [{'product_id': pid, 'quantity': 1, 'price': 1.0} for pid in product_ids]
+   response = client.post('/api/orders', headers=headers,
+                          json={'total_amount': len(items), 'shipping_address': 'x', 'items': items})
+   assert response.status_code == 201
+   drain_jobs()
+   return response.json['order_id']
+
+def drain_jobs():
+   from app import app, work_off_jobs
+   with app.app_context():
+      return work_off_jobs()
+
+def test_related_products(client, user_headers, app):
+   place_order(client, user_headers, [1, 2])
+   place_order(client, user_headers, [1, 2, 3])
+   related = client.get('/api/products/1/related?limit=2').json
+   assert [p['id'] for p in related] == [2, 3]
+
+   with app.app_context():
+      from app import rebuild_related_products
+      rebuild_related_products()
+   related = client.get('/api/products/1/related?limit=2').json
+   assert related[0]['id'] == 2
+
+def test_related_products_falls_back_to_category(client):
+   product = client.get('/api/products/20').json
+   related = client.get('/api/products/20/related').json
+   assert related and all(p['category'] == product['category'] and p['id'] != 20 for p in related)
+
+def test_bestselling_and_trending_sorts(client, user_headers):
+   for _ in range(3):
+      place_order(client, user_headers, [7])
+   order_id = place_order(client, user_headers, [8])
+   place_order(client, user_headers, [8])
+   place_order(client, user_headers, [9])
+   place_order(client, user_headers, [9])
+   assert client.get('/api/products?sort=bestselling&limit=1').json[0]['id'] == 7
+   assert client.get('/api/products?sort=trending&limit=1').json[0]['id'] == 7
+
+   client.post(f'/api/orders/{order_id}/cancel', headers=user_headers)
+   ranked = [p['id'] for p in client.get('/api/products?sort=bestselling').json]
+   assert ranked.index(8) > ranked.index(9)
+
+   category = client.get('/api/products/7').json['category']
+   assert client.get(f'/api/products/category/{category}?sort=bestselling').json[0]['id'] == 7
+
+def test_ranked_sort_includes_new_products(client, admin_headers):
+   response = client.post('/api/admin/products', headers=admin_headers, json={'title': 'New', 'price': 1})
+   product_ids = [p['id'] for p in client.get('/api/products?sort=bestselling').json]
+   assert response.json['id'] in product_ids
+   assert len(product_ids) == len(client.get('/api/products').json)
+
+def start_catalog_version(app):
+   # A version of its own, so change feed reads from it never need a full resync
+   from app import db, bump_catalog_version, publish_catalog_change
+   with app.app_context():
+      version = bump_catalog_version()
+      db.session.commit()
+      publish_catalog_change(version, [])
+   return version
+
+def set_product_stock(client, admin_headers, product_id, stock):
+   response = client.put(f'/api/admin/products/{product_id}', headers=admin_headers, json={'stock': stock})
+   assert response.status_code == 200
+
+def test_checkout_reservation_holds_and_commits_stock(client, user_headers, admin_headers):
+   set_product_stock(client, admin_headers, 11, 5)
+   response = client.post('/api/checkout/reserve', headers=user_headers, json={'items': [{'product_id': 11, 'quantity': 4}]})
+   assert response.status_code == 201
+   assert client.get('/api/products/11').json['stock'] == 1
+
+   # Reserving again replaces the previous hold instead of stacking on it
+   response = client.post('/api/checkout/reserve', headers=user_headers, json={'items': [{'product_id': 11, 'quantity': 6}]})
+   assert response.status_code == 409
+   assert client.get('/api/products/11').json['stock'] == 1
+
+   order_id = place_order(client, user_headers, [11, 11, 11, 11])
+   assert client.get('/api/products/11').json['stock'] == 1
+
+   client.post(f'/api/orders/{order_id}/cancel', headers=user_headers)
+   assert client.get('/api/products/11').json['stock'] == 5
+
+def test_order_rejected_when_out_of_stock(client, user_headers, admin_headers):
+   set_product_stock(client, admin_headers, 12, 1)
+   items = [{'product_id': 12, 'quantity': 2, 'price': 1.0}]
+   response = client.post('/api/orders', headers=user_headers,
+                          json={'total_amount': 2, 'shipping_address': 'x', 'items': items})
+   assert response.status_code == 409
+   assert response.json['product_id'] == 12
+   assert client.get('/api/products/12').json['stock'] == 1
+
+def test_malformed_stock_quantities_are_rejected(client, user_headers, admin_headers):
+   set_product_stock(client, admin_headers, 14, 2)
+   for items in ([{'product_id': 14, 'quantity': -100}], [{'product_id': 14}], [{'product_id': 14, 'quantity': '1'}]):
+      response = client.post('/api/checkout/reserve', headers=user_headers, json={'items': items})
+      assert response.status_code == 400
+      response = client.post('/api/orders', headers=user_headers,
+                             json={'total_amount': 1, 'shipping_address': 'x', 'items': items})
+      assert response.status_code == 400
+   assert client.get('/api/products/14').json['stock'] == 2
+
+def test_admin_stock_must_be_a_non_negative_integer(client, admin_headers):
+   set_product_stock(client, admin_headers, 15, 3)
+   for stock in (-5, 'abc', 1.5):
+      assert client.put('/api/admin/products/15', headers=admin_headers, json={'stock': stock}).status_code == 400
+      assert client.post('/api/admin/products', headers=admin_headers,
+                         json={'title': 'Bad Stock', 'price': 1, 'stock': stock}).status_code == 400
+   assert client.get('/api/products/15').json['stock'] == 3
+
+def test_expired_reservations_are_released(client, user_headers, admin_headers, app):
+   from app import StockReservation, release_expired_reservations, db
+   set_product_stock(client, admin_headers, 13, 2)
+   client.post('/api/checkout/reserve', headers=user_headers, json={'items': [{'product_id': 13, 'quantity': 2}]})
+   assert client.get('/api/products/13').json['stock'] == 0
+   with app.app_context():
+      StockReservation.query.filter_by(product_id=13).update({'expires_at': datetime(2000, 1, 1)})
+      db.session.commit()
+      assert release_expired_reservations() == 1
+   assert client.get('/api/products/13').json['stock'] == 2
+
+def test_bootstrap_anonymous(client):
+   response = client.get('/api/bootstrap')
+   assert response.status_code == 200
+   assert response.json['profile'] is None
+   assert response.json['cart'] == {'items': []}
+   assert response.json['categories'] == client.get('/api/all-categories').json
+   assert response.json['featured'] == client.get('/api/products?limit=3').json
+   assert len(client.get('/api/bootstrap?featured_limit=-1').json['featured']) == 1
+
+def test_bootstrap_field_selection(client, user_headers):
+   client.post('/api/user/cart', headers=user_headers, json={'product_id': 4, 'quantity': 2})
+   response = client.get('/api/bootstrap?fields=profile,cart', headers=user_headers)
+   assert set(response.json) == {'profile', 'cart'}
+   assert response.json['profile']['username'] == 'test-user'
+   assert response.json['cart'] == client.get('/api/user/cart', headers=user_headers).json
+   assert client.get('/api/bootstrap?fields=nope').status_code == 400
+
+def test_bootstrap_catalog_cache_is_invalidated(client, admin_headers):
+   client.get('/api/bootstrap?fields=categories')
+   client.post('/api/admin/products', headers=admin_headers, json={'title': 'Kite', 'price': 5, 'category': 'toys'})
+   assert 'toys' in client.get('/api/bootstrap?fields=categories').json['categories']
+
+def test_order_follow_up_runs_as_job(client, user_headers, app):
+   from app import db, Job, ProductStats
+   with app.app_context():
+      sold_before = db.session.get(ProductStats, 14).units_sold
+   items = [{'product_id': 14, 'quantity': 1, 'price': 1.0}, {'product_id': 15, 'quantity': 1, 'price': 1.0}]
+   client.post('/api/orders', headers=user_headers, json={'total_amount': 2, 'shipping_address': 'x', 'items': items})
+   with app.app_context():
+      assert Job.query.filter_by(name='record_order_cooccurrence', status='queued').count() == 1
+      assert Job.query.filter_by(name='record_order_sales', status='queued').count() == 1
+      assert db.session.get(ProductStats, 14).units_sold == sold_before
+   assert drain_jobs() == 2
+   assert client.get('/api/products/14/related?limit=1').json[0]['id'] == 15
+   with app.app_context():
+      assert db.session.get(ProductStats, 14).units_sold == sold_before + 1
+
+def test_order_cancelled_before_its_sales_job_is_never_counted(client, user_headers, app):
+   from app import db, ProductStats
+   place_order(client, user_headers, [10])
+   with app.app_context():
+      sold_before = db.session.get(ProductStats, 10).units_sold
+   items = [{'product_id': 10, 'quantity': 2, 'price': 1.0}]
+   order_id = client.post('/api/orders', headers=user_headers,
+                          json={'total_amount': 2, 'shipping_address': 'x', 'items': items}).json['order_id']
+   assert client.post(f'/api/orders/{order_id}/cancel', headers=user_headers).status_code == 200
+   drain_jobs()
+   with app.app_context():
+      assert db.session.get(ProductStats, 10).units_sold == sold_before
+
+def test_periodic_jobs_are_scheduled_once_per_interval(app):
+   from app import db, Job, schedule_periodic_jobs
+   with app.app_context():
+      Job.query.filter(Job.name.in_(['release_expired_reservations', 'rebuild_related_products'])).delete()
+      assert sorted(schedule_periodic_jobs()) == ['rebuild_related_products', 'release_expired_reservations']
+      db.session.commit()
+      assert schedule_periodic_jobs() == []
+      db.session.commit()
+   assert drain_jobs() == 2
+
+def test_failing_jobs_retry_then_dead_letter(app, client, admin_headers):
+   from app import db, Job, job_handler, enqueue_job, claim_job, run_job
+   calls = {}
+
+   @job_handler('test_flaky')
+   def flaky(key, fail_times):
+      calls[key] = calls.get(key, 0) + 1
+      if calls[key] <= fail_times:
+         raise RuntimeError('boom')
+
+   with app.app_context():
+      retried = enqueue_job('test_flaky', key='retried', fail_times=1)
+      dead = enqueue_job('test_flaky', key='dead', fail_times=10, max_attempts=2)
+      db.session.commit()
+
+      assert run_job(claim_job('test')) is False
+      retried = db.session.get(Job, retried.id)
+      assert retried.status == 'queued' and retried.run_at > datetime.utcnow()
+      retried.run_at = datetime(2000, 1, 1)
+      db.session.commit()
+      assert run_job(claim_job('test')) is True
+
+      for _ in range(2):
+         job = claim_job('test')
+         assert job.id == dead.id
+         run_job(job)
+         Job.query.filter_by(id=dead.id, status='queued').update({'run_at': datetime.utcnow()})
+         db.session.commit()
+      dead = db.session.get(Job, dead.id)
+      assert dead.status == 'dead' and 'boom' in dead.last_error
+      assert claim_job('test') is None
+
+   metrics = client.get('/api/admin/jobs/metrics', headers=admin_headers).json
+   assert metrics['counts']['dead'] >= 1
+   assert metrics['last_hour']['completed'] >= 1
+
+def test_header_triggered_profile(client, admin_headers, app, monkeypatch, tmp_path):
+   from app import profile_store
+   monkeypatch.setitem(app.config, 'PROFILER_SECRET', 'profile-secret')
+   monkeypatch.setattr(profile_store, 'directory', str(tmp_path))
+
+   assert 'X-Profile-Id' not in client.get('/api/products').headers
+   assert 'X-Profile-Id' not in client.get('/api/products', headers={'X-Profile': '1.bogus'}).headers
+
+   token = client.post('/api/admin/profiles/token', headers=admin_headers, json={}).json['token']
+   response = client.get('/api/products', headers={'X-Profile': token})
+   profile_id = response.headers['X-Profile-Id']
+
+   profiles = client.get('/api/admin/profiles', headers=admin_headers).json
+   assert profiles[0]['id'] == profile_id
+   assert profiles[0]['route'] == '/api/products'
+   assert profiles[0]['sql_queries'] >= 1
+   assert profiles[0]['serialize_ms'] > 0
+   download = client.get(f'/api/admin/profiles/{profile_id}', headers=admin_headers)
+   assert download.status_code == 200
+   assert client.get('/api/admin/profiles/missing', headers=admin_headers).status_code == 404
+
+def test_sampled_profiles(client, app, monkeypatch, tmp_path):
+   from app import profile_store
+   monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 1.0)
+   monkeypatch.setattr(profile_store, 'directory', str(tmp_path))
+   assert 'X-Profile-Id' in client.get('/api/products/categories').headers
+
+def test_bulk_import_creates_and_updates(client, admin_headers):
+   upload = (
+      "sku,title,price,category,stock\n"
+      "BULK-1,Bulk Lantern,12.5,bulk goods,4\n"
+      "BULK-2,Bulk Candle,3,bulk goods,\n"
+      "BULK-3,,oops,,\n"
+      ",Missing Key,1,,\n"
+   )
+   response = client.post('/api/admin/products/bulk', headers=admin_headers,
+                          data=upload, content_type='text/csv')
+   assert response.status_code == 200
+   result = response.json
+   assert (result['processed'], result['created'], result['updated'], result['failed']) == (4, 2, 0, 2)
+   assert [e['row'] for e in result['errors']] == [3, 4]
+   version = result['version']
+
+   lantern = client.get('/api/products/search?q=bulk lantern').json[0]
+   assert lantern['title'] == 'Bulk Lantern'
+   assert client.get(f"/api/products/{lantern['id']}").json['stock'] == 4
+   assert 'bulk goods' in client.get('/api/products/categories').json
+   assert client.get('/api/products/suggest?q=bulk lan').json['products'][0]['id'] == lantern['id']
+
+   update = '{"sku": "BULK-2", "price": 4.25}\n{"id": %d, "title": "Bulk Lamp"}\n' % lantern['id']
+   result = client.post('/api/admin/products/bulk', headers=admin_headers,
+                        data=update, content_type='application/x-ndjson').json
+   assert (result['created'], result['updated'], result['failed']) == (0, 2, 0)
+   assert result['version'] == version + 1
+   assert client.get(f"/api/products/{lantern['id']}").json['title'] == 'Bulk Lamp'
+   assert client.get('/api/products/suggest?q=bulk lam').json['products'][0]['id'] == lantern['id']
+
+def test_bulk_import_dry_run_and_errors(client, admin_headers, user_headers):
+   upload = '{"sku": "DRY-1", "title": "Dry Run Kettle", "price": 9}\n{"id": 999999, "price": 1}\nnot json\n'
+   assert client.post('/api/admin/products/bulk', headers=user_headers,
+                      data=upload, content_type='application/x-ndjson').status_code == 403
+   assert client.post('/api/admin/products/bulk', headers=admin_headers,
+                      data=upload, content_type='application/json').status_code == 415
+
+   result = client.post('/api/admin/products/bulk?dry_run=true', headers=admin_headers,
+                        data=upload, content_type='application/x-ndjson').json
+   assert (result['created'], result['failed'], result['version']) == (1, 2, None)
+   assert {e['row'] for e in result['errors']} == {2, 3}
+   assert client.get('/api/products/search?q=kettle').json == []
+
+   result = client.post('/api/admin/products/bulk', headers=admin_headers,
+                        data=b'\xff\xfe bad', content_type='text/csv')
+   assert result.status_code == 200 and result.json['failed'] == 1
+
+def test_bulk_import_failure_still_publishes_committed_chunks(client, admin_headers, app, monkeypatch):
+   import app as app_module
+   real_import = app_module.import_product_chunk
+   calls = []
+
+   def flaky_import(*args, **kwargs):
+      calls.append(1)
+      if len(calls) == 2:
+         raise RuntimeError('database went away')
+      return real_import(*args, **kwargs)
+
+   monkeypatch.setattr(app_module, 'import_product_chunk', flaky_import)
+   monkeypatch.setitem(app.config, 'BULK_IMPORT_CHUNK_SIZE', 1)
+   version = start_catalog_version(app)
+   upload = '{"sku": "HALF-1", "title": "Half Upload Vase", "price": 5}\n{"sku": "HALF-2", "title": "Half Upload Bowl", "price": 6}\n'
+   with pytest.raises(RuntimeError):
+      client.post('/api/admin/products/bulk', headers=admin_headers,
+                  data=upload, content_type='application/x-ndjson')
+   feed = client.get(f'/api/products/changes?since={version}').json
+   assert [p['title'] for p in feed['changes']] == ['Half Upload Vase']
+
+def test_bulk_order_status_transitions(client, admin_headers, user_headers, app):
+   from app import ProductStats
+   set_product_stock(client, admin_headers, 16, 5)
+   first = place_order(client, user_headers, [16])
+   second = place_order(client, user_headers, [16, 17])
+   shipped = place_order(client, user_headers, [17])
+   assert client.put(f'/api/admin/orders/{shipped}', headers=admin_headers,
+                     json={'status': 'shipped'}).status_code == 200
+
+   response = client.post('/api/admin/orders/bulk-status', headers=admin_headers,
+                          json={'ids': [first, second, shipped, 999999], 'status': 'cancelled'})
+   assert response.status_code == 200
+   assert [r['outcome'] for r in response.json['results']] == ['updated', 'updated', 'invalid_transition', 'not_found']
+   assert client.get('/api/products/16').json['stock'] == 5
+   with app.app_context():
+      from app import db
+      assert db.session.get(ProductStats, 16).units_sold == 0
+      assert db.session.get(ProductStats, 17).units_sold == 1
+
+   assert client.put(f'/api/admin/orders/{first}', headers=admin_headers,
+                     json={'status': 'pending'}).status_code == 400
+   result = client.post('/api/admin/orders/bulk-status', headers=admin_headers,
+                        json={'filter': {'status': 'shipped'}, 'status': 'delivered'}).json
+   assert {'id': shipped, 'from': 'shipped', 'outcome': 'updated'} in result['results']
+   assert client.post('/api/admin/orders/bulk-status', headers=admin_headers,
+                      json={'ids': [first], 'status': 'lost'}).status_code == 400
+
+def test_product_filters_and_facets(client, admin_headers):
+   everything = client.get('/api/products').json
+   cheap = client.get('/api/products?max_price=20&min_rating=3&sort=price_desc').json
+   expected = [p for p in everything if p['price'] <= 20 and (p['rating']['rate'] or 0) >= 3]
+   assert [p['id'] for p in cheap] == [p['id'] for p in sorted(expected, key=lambda p: (-p['price'], p['id']))]
+
+   categories = sorted({p['category'] for p in everything if p['category']})[:2]
+   query = '&'.join(f'category={c}' for c in categories)
+   result = client.get(f'/api/products?{query}&include_facets=true&limit=2&sort=rating').json
+   matching = [p for p in everything if p['category'] in categories]
+   assert result['total'] == len(matching)
+   assert len(result['products']) == 2
+   counts = {f['value']: f['count'] for f in result['facets']['categories']}
+   assert counts[categories[0]] == sum(1 for p in everything if p['category'] == categories[0])
+   assert sum(b['count'] for b in result['facets']['price']) == len(matching)
+
+   response = client.post('/api/admin/products', headers=admin_headers,
+                          json={'title': 'Facet Probe', 'price': 9999, 'category': categories[0]})
+   facets = client.get(f'/api/products/category/{categories[0]}?include_facets=true&min_price=9000').json
+   assert [p['id'] for p in facets['products']] == [response.json['id']]
+   assert facets['total'] == 1
+
+def test_columnar_catalog_matches_sql(client, app, admin_headers, monkeypatch, tmp_path):
+   queries = ['sort=price_desc&limit=5', 'min_rating=4&sort=rating', 'max_price=30&sort=price_asc&offset=2&limit=3',
+              'category=electronics&category=home&sort=desc&include_facets=true']
+   from_sql = [client.get(f'/api/products?{q}').json for q in queries]
+   monkeypatch.setitem(app.config, 'COLUMNAR_CATALOG', True)
+   monkeypatch.setitem(app.config, 'COLUMNAR_CATALOG_DIR', str(tmp_path))
+   with app.app_context():
+      from app import build_columnar_snapshot
+      assert build_columnar_snapshot()
+   assert [client.get(f'/api/products?{q}').json for q in queries] == from_sql
+   from app import columnar_state, catalog_state
+   assert columnar_state['catalog'] is not None
+
+   response = client.post('/api/admin/products', headers=admin_headers,
+                          json={'title': 'Columnar Probe', 'price': 123456, 'category': 'home'})
+   with app.app_context():
+      build_columnar_snapshot()
+   assert client.get('/api/products?sort=price_desc&limit=1').json[0]['id'] == response.json['id']
+   assert columnar_state['version'] == catalog_state['version']
+
+def test_columnar_build_backs_off_while_another_process_builds(client, app, monkeypatch, tmp_path):
+   import time
+   import app as app_module
+   attempts = []
+
+   def locked_elsewhere(version=None):
+      attempts.append(version)
+      return False
+
+   monkeypatch.setitem(app.config, 'COLUMNAR_CATALOG', True)
+   monkeypatch.setitem(app.config, 'COLUMNAR_CATALOG_DIR', str(tmp_path))
+   monkeypatch.setitem(app_module.columnar_state, 'retry_at', 0.0)
+   monkeypatch.setitem(app_module.columnar_state, 'version', None)
+   monkeypatch.setattr(app_module, 'build_columnar_snapshot', locked_elsewhere)
+   for _ in range(3):
+      assert client.get('/api/products?sort=price_desc&limit=1').status_code == 200
+      while app_module.columnar_state['building'] is not None:
+         time.sleep(0.01)
+   assert len(attempts) == 1
+
+def test_archived_orders_are_still_served(client, user_headers, app):
+   from datetime import timedelta
+   from app import db, Order, ArchivedOrder, ProductStats, archive_orders, rebuild_product_stats
+   old = place_order(client, user_headers, [18, 19])
+   open_old = place_order(client, user_headers, [19])
+   place_order(client, user_headers, [18])
+   with app.app_context():
+      order = db.session.get(Order, old)
+      order.status = 'delivered'
+      order.created_at = datetime.utcnow() - timedelta(days=400)
+      # Still pending, so it stays live although it is the oldest
+      db.session.get(Order, open_old).created_at = datetime.utcnow() - timedelta(days=500)
+      db.session.commit()
+      assert archive_orders(datetime.utcnow() - timedelta(days=365)) == 1
+      assert db.session.get(Order, old) is None
+      assert ArchivedOrder.query.filter_by(id=old).count() == 1
+      rebuild_product_stats()
+      assert db.session.get(ProductStats, 18).units_sold == 2
+
+   archived = client.get(f'/api/orders/{old}', headers=user_headers).json
+   assert archived['archived'] and archived['status'] == 'delivered'
+   assert sorted(item['product_id'] for item in archived['items']) == [18, 19]
+   history = client.get('/api/user/orders', headers=user_headers).json
+   assert [order['id'] for order in history[-2:]] == [old, open_old]
+
+def test_idle_carts_are_purged(client, admin_headers, user_headers, app):
+   from datetime import timedelta
+   from app import db, Cart, CartItem, purge_idle_carts
+   client.post('/api/user/cart', headers=admin_headers, json={'product_id': 5, 'quantity': 1})
+   client.post('/api/user/cart', headers=user_headers, json={'product_id': 5, 'quantity': 1})
+   with app.app_context():
+      admin_cart = Cart.query.join(Cart.items).filter(CartItem.product_id == 5).order_by(Cart.id).first()
+      admin_cart.updated_at = datetime.utcnow() - timedelta(days=60)
+      db.session.commit()
+      assert purge_idle_carts(datetime.utcnow() - timedelta(days=30), chunk_size=1) == (1, False)
+      assert CartItem.query.filter_by(product_id=5).count() == 1
+
+def test_catalog_change_feed(client, admin_headers, app):
+   start = client.get('/api/products/changes?since=0').json
+   assert start['full_resync'] == (start['version'] > 0)
+   version = start_catalog_version(app)
+   assert client.get(f'/api/products/changes?since={version}').json['changes'] == []
+   assert client.get(f'/api/products/changes?since={version}&limit=0').status_code == 400
+
+   created = client.post('/api/admin/products', headers=admin_headers, json={'title': 'Feed A', 'price': 1}).json['id']
+   doomed = client.post('/api/admin/products', headers=admin_headers, json={'title': 'Feed B', 'price': 2}).json['id']
+   client.put(f'/api/admin/products/{created}', headers=admin_headers, json={'price': 3})
+   client.delete(f'/api/admin/products/{doomed}', headers=admin_headers)
+
+   feed = client.get(f'/api/products/changes?since={version}').json
+   assert [(p['id'], p['price']) for p in feed['changes']] == [(created, 3)]
+   assert [d['id'] for d in feed['deleted']] == [doomed]
+   assert feed['version'] == version + 4 and not feed['has_more']
+
+   first = client.get(f'/api/products/changes?since={version}&limit=1').json
+   assert first['has_more'] and len(first['changes'] + first['deleted']) == 1
+   seen = [p['id'] for p in first['changes'] + first['deleted']]
+   page = first
+   while page['has_more']:
+      page = client.get('/api/products/changes', query_string=dict(page['next'], limit=1)).json
+      seen += [p['id'] for p in page['changes'] + page['deleted']]
+   assert sorted(seen) == sorted([created, doomed])
+   assert client.get(f"/api/products/changes?since={feed['version'] + 10}").json['full_resync']
+
+   with app.app_context():
+      from app import compact_catalog_changes
+      assert compact_catalog_changes(datetime.utcnow()) >= 1
+   assert client.get(f'/api/products/changes?since={version}').json['full_resync']
+   assert not client.get(f"/api/products/changes?since={feed['version']}").json['full_resync']
+
+def test_noop_seed_leaves_catalog_version_alone(client):
+   version = client.get('/api/products/changes?since=0').json['version']
+   assert client.post('/api/seed-products').status_code == 200
+   feed = client.get(f'/api/products/changes?since={version}').json
+   assert feed['version'] == version and feed['changes'] == []
+
+def test_rating_sort_lists_unrated_products_last(client, admin_headers):
+   client.post('/api/admin/products', headers=admin_headers, json={'title': 'Unrated Stool', 'price': 1})
+   rates = [p['rating']['rate'] for p in client.get('/api/products?sort=rating').json]
+   rated = [r for r in rates if r is not None]
+   assert rates == rated + [None] * (len(rates) - len(rated))
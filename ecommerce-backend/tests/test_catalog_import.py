@@ -0,0 +1,31 @@
+import io
+
+from catalog_import import iter_rows, validate_row
+
+
+def test_iter_rows_csv_and_ndjson():
+   csv_rows = list(iter_rows(io.BytesIO(b"\xef\xbb\xbfid,price\n1,2.5\n2,3,extra\n"), 'text/csv'))
+   assert csv_rows[0] == (1, {'id': '1', 'price': '2.5'}, None)
+   assert csv_rows[1][1] is None and csv_rows[1][2]
+
+   ndjson_rows = list(iter_rows(io.BytesIO(b'{"id": 1}\n\n[1]\n{bad\n'), 'application/x-ndjson'))
+   assert [(n, row) for n, row, _ in ndjson_rows] == [(1, {'id': 1}), (3, None), (4, None)]
+
+def test_iter_rows_reports_undecodable_rows():
+   csv_rows = list(iter_rows(io.BytesIO(b'id,title\n1,Mug\n2,"Bad \xff\n Cup"\n3,Bowl\n'), 'text/csv'))
+   assert [(n, row and row['id'], error) for n, row, error in csv_rows] == [
+      (1, '1', None), (2, None, 'Row is not valid UTF-8'), (3, '3', None)]
+   assert list(iter_rows(io.BytesIO(b'\xff\xfe bad'), 'text/csv')) == [(1, None, 'Header is not valid UTF-8')]
+
+   ndjson_rows = list(iter_rows(io.BytesIO(b'\xff\xfe bad\n{"id": 2}\n'), 'application/x-ndjson'))
+   assert ndjson_rows == [(1, None, 'Line is not valid UTF-8'), (2, {'id': 2}, None)]
+
+def test_validate_row():
+   assert validate_row({'id': '3', 'price': '', 'title': ' Mug '}) == ({'id': 3, 'title': 'Mug'}, [])
+   assert validate_row({'sku': 'A-1', 'price': 2, 'stock': '5'}) == ({'sku': 'A-1', 'price': 2.0, 'stock': 5}, [])
+   assert validate_row({'title': 'No key'})[1] == ['id or sku is required']
+   assert validate_row({'id': 1, 'rating': '3.96'})[0]['rating'] == 4.0
+   assert validate_row({'id': 1, 'category': 'c' * 101, 'image': 'i' * 201})[1] == [
+      'category must be at most 100 characters', 'image must be at most 200 characters']
+   values, errors = validate_row({'id': 'x', 'price': -1, 'rating': 6})
+   assert len(errors) == 3
@@ -0,0 +1,63 @@
+import random
+
+import columnar_catalog
+from columnar_catalog import ColumnarCatalog, ensure_snapshot, prune_snapshots
+
+
+def make_rows(n=500, seed=7):
+   rng = random.Random(seed)
+   rows = []
+   for product_id in range(1, n + 1):
+      rows.append((
+         product_id,
+         f"Product {product_id} é",
+         round(rng.uniform(1, 100), 0),
+         None if product_id % 7 == 0 else f"Description {product_id}",
+         rng.choice(['books', 'toys', 'garden', None]),
+         '',
+         None if product_id % 11 == 0 else round(rng.uniform(1, 5), 1),
+         None if product_id % 11 == 0 else rng.randint(0, 50),
+      ))
+   return rows
+
+def expected(rows, key, categories=None, min_price=None, min_rating=None):
+   matching = [r for r in rows
+               if (not categories or r[4] in categories)
+               and (min_price is None or r[2] >= min_price)
+               and (min_rating is None or (r[6] is not None and r[6] >= min_rating))]
+   return [r[0] for r in sorted(matching, key=key)]
+
+def test_query_matches_sql_orderings(tmp_path, monkeypatch):
+   rows = make_rows()
+   path = str(tmp_path / 'v1')
+   assert ensure_snapshot(path, lambda: rows)
+   catalog = ColumnarCatalog.load(path)
+
+   def ids(**kwargs):
+      return [p['id'] for p in catalog.rows(catalog.query(**kwargs))]
+
+   price_desc = expected(rows, lambda r: (-r[2], r[0]), categories=['books', 'toys'])
+   assert ids(categories=['books', 'toys'], sort='price_desc', limit=15, offset=5) == price_desc[5:20]
+   assert catalog.count(categories=['books', 'toys']) == len(price_desc)
+   rating = expected(rows, lambda r: (r[6] is None, -(r[6] or 0), -(r[7] if r[7] is not None else -1), r[0]))
+   assert ids(sort='rating', limit=30) == rating[:30]
+   assert ids(sort='rating') == rating
+   selective = expected(rows, lambda r: -r[0], categories=['garden'], min_price=95, min_rating=4.5)
+   assert ids(categories=['garden'], min_price=95, min_rating=4.5, sort='desc', limit=3) == selective[:3]
+   monkeypatch.setattr(columnar_catalog, 'SCAN_CHUNK', 2)
+   assert ids(categories=['garden'], min_price=95, min_rating=4.5, sort='desc', limit=3) == selective[:3]
+   assert ids(categories=['books', 'toys'], sort='price_desc', limit=15, offset=5) == price_desc[5:20]
+   assert ids(min_price=50, min_rating=3, sort='desc') == expected(rows, lambda r: -r[0], min_price=50, min_rating=3)
+   assert ids(categories=['nope'], limit=5) == []
+
+   product = catalog.rows(catalog.query(limit=7))[-1]
+   assert product['description'] is None and product['title'] == 'Product 7 é'
+   assert product['rating']['rate'] == rows[6][6]
+
+def test_snapshots_are_pruned(tmp_path):
+   for version in range(1, 5):
+      ensure_snapshot(str(tmp_path / f'v{version}'), lambda: make_rows(5))
+   (tmp_path / 'v5.lock').touch()
+   assert not ensure_snapshot(str(tmp_path / 'v5'), lambda: make_rows(5))
+   prune_snapshots(str(tmp_path))
+   assert sorted(p.name for p in tmp_path.iterdir()) == ['v3', 'v4', 'v5.lock']
@@ -0,0 +1,43 @@
+from facets import FacetIndex
+
+ROWS = [
+   (1, 'books', 10.0, 4.5),
+   (2, 'books', 30.0, 3.2),
+   (3, 'toys', 30.0, 4.1),
+   (4, 'toys', 120.0, 2.0),
+   (5, None, 600.0, None),
+]
+
+def build():
+   index = FacetIndex()
+   index.build(ROWS)
+   return index
+
+def test_count_applies_every_filter():
+   index = build()
+   assert index.count() == 5
+   assert index.count(categories=['books', 'toys'], max_price=30) == 3
+   assert index.count(min_price=30, min_rating=4) == 1
+
+def test_facets_ignore_their_own_filter():
+   facets = build().facets(categories=['books'], min_rating=4)
+   assert facets['categories'] == [{'value': 'books', 'count': 1}, {'value': 'toys', 'count': 1}]
+   assert [b['count'] for b in facets['price']] == [1, 0, 0, 0, 0, 0]
+   assert facets['price'][-1] == {'min': 500, 'max': None, 'count': 0}
+   assert [b['count'] for b in facets['rating']] == [1, 2, 2, 2]
+
+def test_upsert_and_remove():
+   index = build()
+   index.upsert(2, 'toys', 5.0, 4.0)
+   assert index.count(categories=['toys'], min_rating=4) == 2
+   index.remove(2)
+   index.remove(2)
+   assert index.count() == 4
+   assert index.count(categories=['books']) == 1
+
+def test_min_rating_compares_exact_ratings():
+   index = FacetIndex()
+   index.build([(1, 'books', 10.0, 3.96), (2, 'books', 10.0, 4.0), (3, 'books', 10.0, None)])
+   assert index.count(min_rating=4) == 1
+   assert index.count(min_rating=0) == 2
+   assert [b['count'] for b in index.facets()['rating']] == [1, 2, 2, 2]
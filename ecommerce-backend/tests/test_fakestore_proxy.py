@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def slow_fakestore(monkeypatch):
+   import app as app_module
+   delays = {'/carts/2': 0.5, '/carts/3': 0.3}
+   hits = {}
+
+   class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+         hits[self.path] = hits.get(self.path, 0) + 1
+         time.sleep(delays.get(self.path, 0))
+         data = json.dumps({'id': int(self.path.rsplit('/', 1)[1]), 'products': []}).encode()
+         self.send_response(200)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(data)))
+         self.end_headers()
+         self.wfile.write(data)
+
+      def log_message(self, *args):
+         pass
+
+   server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+   server.daemon_threads = True
+   server.hits = hits
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   monkeypatch.setattr(app_module, 'FAKESTORE_API_URL', f"http://127.0.0.1:{server.server_address[1]}")
+   monkeypatch.setattr(app_module, 'FAKESTORE_TIMEOUT', (1, 0.2))
+   yield server
+   server.shutdown()
+
+def test_proxy_uses_configured_upstream_and_times_out(slow_fakestore, client):
+   from app import make_api_request
+   assert client.get('/api/carts/1').json == {'id': 1, 'products': []}
+   body, status = make_api_request('carts/2')
+   assert status == 500 and 'timed out' in body['message'].lower()
+
+def test_identical_concurrent_requests_share_one_upstream_call(slow_fakestore, app, admin_headers, monkeypatch):
+   import app as app_module
+   monkeypatch.setattr(app_module, 'FAKESTORE_TIMEOUT', (1, 2))
+   before = app.test_client().get('/api/admin/single-flight/metrics', headers=admin_headers).json
+   start = threading.Barrier(10)
+   responses = []
+
+   def fetch():
+      client = app.test_client()
+      start.wait()
+      responses.append(client.get('/api/carts/3'))
+
+   threads = [threading.Thread(target=fetch) for _ in range(10)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+
+   assert slow_fakestore.hits['/carts/3'] == 1
+   assert [r.status_code for r in responses] == [200] * 10
+   assert all(r.json == {'id': 3, 'products': []} for r in responses)
+   after = app.test_client().get('/api/admin/single-flight/metrics', headers=admin_headers).json
+   assert after['executions'] - before['executions'] == 1
+   assert after['shared'] - before['shared'] == 9
+   assert after['in_flight'] == 0
@@ -0,0 +1,128 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import stripe
+
+
+class StripeStandIn:
+   """Just enough of the PaymentIntent API, including idempotency keys, to run offline."""
+
+   def __init__(self):
+      self.intents = {}
+      self.idempotent = {}
+      self.calls = []
+      stand_in = self
+
+      class Handler(BaseHTTPRequestHandler):
+         def do_POST(self):
+            body = parse_qs(self.rfile.read(int(self.headers['Content-Length'] or 0)).decode())
+            params = {k: v[0] for k, v in body.items()}
+            key = self.headers.get('Idempotency-Key')
+            if key in stand_in.idempotent:
+               status, payload = stand_in.idempotent[key]
+            else:
+               status, payload = stand_in.handle(self.path, params)
+               if key:
+                  stand_in.idempotent[key] = (status, payload)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+         def log_message(self, *args):
+            pass
+
+      self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+      self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+   def handle(self, path, params):
+      parts = path.strip('/').split('/')
+      if parts[:2] != ['v1', 'payment_intents']:
+         return 404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path'}}
+      if len(parts) == 2:
+         self.calls.append('create')
+         intent_id = f"pi_{len(self.intents) + 1}"
+         self.intents[intent_id] = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': int(params['amount']),
+            'currency': params['currency'],
+            'client_secret': f"{intent_id}_secret",
+            'status': 'requires_payment_method'
+         }
+         return 200, self.intents[intent_id]
+      self.calls.append('modify')
+      intent = self.intents[parts[2]]
+      if intent['status'] == 'succeeded':
+         return 400, {'error': {'type': 'invalid_request_error', 'message': 'PaymentIntent already succeeded'}}
+      intent['amount'] = int(params['amount'])
+      return 200, intent
+
+
+@pytest.fixture
+def stripe_stand_in(monkeypatch):
+   stand_in = StripeStandIn()
+   thread = threading.Thread(target=stand_in.server.serve_forever, daemon=True)
+   thread.start()
+   monkeypatch.setattr(stripe, 'api_base', stand_in.url)
+   yield stand_in
+   stand_in.server.shutdown()
+
+def create_intent(client, headers, amount, items):
+   response = client.post('/api/checkout/create-payment-intent', headers=headers, json={
+      'amount': amount,
+      'items': [{'product_id': pid, 'quantity': q} for pid, q in items]
+   })
+   assert response.status_code == 200, response.json
+   return response.json['clientSecret']
+
+def test_same_cart_reuses_intent(client, user_headers, stripe_stand_in):
+   first = create_intent(client, user_headers, 1000, [(1, 1), (2, 2)])
+   again = create_intent(client, user_headers, 1000, [(2, 2), (1, 1)])
+   assert first == again
+   assert stripe_stand_in.calls == ['create']
+
+def test_changed_amount_modifies_intent(client, user_headers, stripe_stand_in):
+   first = create_intent(client, user_headers, 500, [(3, 1)])
+   second = create_intent(client, user_headers, 450, [(3, 1)])
+   assert first == second
+   assert stripe_stand_in.calls == ['create', 'modify']
+   assert stripe_stand_in.intents['pi_1']['amount'] == 450
+
+def test_amount_returning_to_earlier_value_is_modified_again(client, user_headers, stripe_stand_in):
+   secrets = {create_intent(client, user_headers, amount, [(7, 1)]) for amount in (500, 450, 500, 450)}
+   assert len(secrets) == 1
+   assert stripe_stand_in.calls == ['create', 'modify', 'modify', 'modify']
+   assert stripe_stand_in.intents['pi_1']['amount'] == 450
+
+def test_new_cart_or_finished_intent_gets_new_intent(client, user_headers, stripe_stand_in):
+   first = create_intent(client, user_headers, 700, [(4, 1)])
+   assert create_intent(client, user_headers, 1400, [(4, 2)]) != first
+
+   stripe_stand_in.intents['pi_1']['status'] = 'succeeded'
+   replaced = create_intent(client, user_headers, 650, [(4, 1)])
+   assert replaced != first
+   assert stripe_stand_in.calls == ['create', 'create', 'modify', 'create']
+
+def test_placing_order_releases_cart_intent(client, user_headers, stripe_stand_in):
+   first = create_intent(client, user_headers, 100, [(5, 1)])
+   items = [{'product_id': 5, 'quantity': 1, 'price': 1.0}]
+   client.post('/api/orders', headers=user_headers, json={'total_amount': 1, 'shipping_address': 'x', 'items': items})
+   assert create_intent(client, user_headers, 100, [(5, 1)]) != first
+
+def test_stale_cache_entry_from_another_worker_is_not_reused(client, user_headers, stripe_stand_in):
+   import app as app_module
+   first = create_intent(client, user_headers, 100, [(6, 1)])
+   with app_module.payment_intent_cache_lock:
+      stale = {k: v for k, v in app_module.payment_intent_cache.items() if v[1] == first}
+   items = [{'product_id': 6, 'quantity': 1, 'price': 1.0}]
+   client.post('/api/orders', headers=user_headers, json={'total_amount': 1, 'shipping_address': 'x', 'items': items})
+   # As if the order had been placed by a worker that never held this entry
+   with app_module.payment_intent_cache_lock:
+      app_module.payment_intent_cache.update(stale)
+   assert create_intent(client, user_headers, 100, [(6, 1)]) != first
@@ -0,0 +1,39 @@
+import time
+
+from profiler import ProfileStore, RequestProfile, sign_profile_token, verify_profile_token
+
+
+def test_profile_tokens():
+   token = sign_profile_token('secret', time.time() + 60)
+   assert verify_profile_token('secret', token)
+   assert not verify_profile_token('other', token)
+   assert not verify_profile_token('secret', sign_profile_token('secret', time.time() - 1))
+   assert not verify_profile_token(None, token)
+   assert not verify_profile_token('secret', 'garbage')
+
+def busy():
+   deadline = time.perf_counter() + 0.05
+   while time.perf_counter() < deadline:
+      pass
+
+def test_sampler_writes_collapsed_stacks(tmp_path):
+   store = ProfileStore(str(tmp_path), keep=2)
+   for _ in range(3):
+      profile = RequestProfile('sampler', interval=0.001)
+      busy()
+      profile.finish()
+      meta = store.save(profile, {'route': '/x'})
+   assert meta['samples'] > 0
+   with open(store.path_for(meta['id'])) as f:
+      assert 'busy (test_profiler.py' in f.read()
+   assert [p['id'] for p in store.list()][0] == meta['id']
+   assert len(store.list()) == 2
+   assert store.path_for('../etc/passwd') is None
+
+def test_cprofile_mode(tmp_path):
+   store = ProfileStore(str(tmp_path))
+   profile = RequestProfile('cprofile')
+   busy()
+   profile.finish()
+   meta = store.save(profile, {})
+   assert store.path_for(meta['id']).endswith('.prof')
@@ -0,0 +1,19 @@
+from recommendations import top_k_cooccurrence
+
+
+def test_counts_orders_in_common():
+   related = top_k_cooccurrence(
+      [1, 1, 1, 2, 2, 3, 3, 3],
+      [10, 20, 30, 10, 20, 10, 30, 30],
+      k=2
+   )
+   assert related[10] == [(20, 2), (30, 2)]
+   assert related[20] == [(10, 2), (30, 1)]
+   assert related[30] == [(10, 2), (20, 1)]
+
+def test_keeps_top_k_only():
+   related = top_k_cooccurrence([1, 1, 1, 2, 2], [5, 6, 7, 5, 7], k=1)
+   assert related[5] == [(7, 2)]
+
+def test_no_orders():
+   assert top_k_cooccurrence([], []) == {}
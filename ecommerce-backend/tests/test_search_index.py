@@ -0,0 +1,44 @@
+from search_index import PrefixIndex
+
+
+def make_index(**kwargs):
+   index = PrefixIndex(**kwargs)
+   index.build([
+      (1, 'Fjallraven Backpack', "men's clothing", 3.9, 120),
+      (2, 'Leather Backpack', 'accessories', 4.5, 30),
+      (3, 'Mens Casual Jacket', "men's clothing", 4.7, 500),
+      (4, 'Bamboo Cutting Board', 'kitchen', 4.1, 70),
+   ])
+   return index
+
+def test_prefix_matches_rank_by_rating():
+   products, _ = make_index().suggest('back')
+   assert [pid for pid, _ in products] == [2, 1]
+
+def test_every_term_must_match():
+   products, _ = make_index().suggest('fjall back')
+   assert [pid for pid, _ in products] == [1]
+
+def test_categories_are_suggested():
+   _, categories = make_index().suggest('cloth')
+   assert categories == ["men's clothing"]
+
+def test_incremental_updates():
+   index = make_index()
+   index.upsert(5, 'Hiking Backpack', 'outdoors', 5.0, 10)
+   index.upsert(2, 'Leather Wallet', 'accessories', 4.5, 30)
+   index.remove(1)
+   products, _ = index.suggest('back')
+   assert [pid for pid, _ in products] == [5]
+   _, categories = index.suggest('men')
+   assert categories == ["men's clothing"]
+
+def test_wide_prefix_cache_is_invalidated():
+   index = make_index(scan_limit=1, cache_depth=2)
+   assert [pid for pid, _ in index.suggest('b')[0]] == [2, 4, 1]
+   index.upsert(6, 'Bucket', 'home', 4.9, 5)
+   assert [pid for pid, _ in index.suggest('b', limit=2)[0]] == [6, 2]
+
+def test_multi_term_fallback_scan_is_capped():
+   assert [pid for pid, _ in make_index().suggest('m c')[0]] == [3, 1]
+   assert [pid for pid, _ in make_index(max_scan=1).suggest('m c')[0]] == [1]
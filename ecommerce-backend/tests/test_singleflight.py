@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight, SingleFlightTimeout
+
+
+def run_together(n, target):
+   threads = [threading.Thread(target=target) for _ in range(n)]
+   for thread in threads:
+      thread.start()
+   for thread in threads:
+      thread.join()
+
+def test_concurrent_calls_share_one_execution():
+   flight = SingleFlight()
+   start = threading.Barrier(8)
+   calls = []
+   results = []
+
+   def work():
+      calls.append(1)
+      time.sleep(0.2)
+      return object()
+
+   def caller():
+      start.wait()
+      results.append(flight.do('key', work))
+
+   run_together(8, caller)
+   assert len(calls) == 1
+   assert len(results) == 8 and all(r is results[0] for r in results)
+   assert flight.metrics() == {'requests': 8, 'executions': 1, 'shared': 7, 'errors': 0,
+                               'timeouts': 0, 'in_flight': 0, 'coalescing_ratio': 0.875}
+   # Nothing is kept once the call is done
+   assert flight.do('key', lambda: 'fresh') == 'fresh'
+
+def test_error_reaches_every_waiter():
+   flight = SingleFlight()
+   start = threading.Barrier(4)
+   errors = []
+
+   def fail():
+      time.sleep(0.2)
+      raise ValueError('upstream down')
+
+   def caller():
+      start.wait()
+      try:
+         flight.do('key', fail)
+      except ValueError as e:
+         errors.append(e)
+
+   run_together(4, caller)
+   assert len(errors) == 4 and all(e is errors[0] for e in errors)
+   assert flight.metrics()['errors'] == 1
+
+def test_waiter_times_out():
+   flight = SingleFlight()
+   release = threading.Event()
+   leader = threading.Thread(target=flight.do, args=('key', release.wait))
+   leader.start()
+   while not flight.metrics()['in_flight']:
+      time.sleep(0.01)
+   with pytest.raises(SingleFlightTimeout):
+      flight.do('key', lambda: 'unused', timeout=0.05)
+   release.set()
+   leader.join()
+   assert flight.metrics()['timeouts'] == 1